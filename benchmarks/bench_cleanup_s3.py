@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+    Drift game server management - S3 cleanup benchmark
+    ------------------------------------------------
+    Fills a bucket on a local S3 stand-in with old build files, most of them
+    unreferenced by the index, and times cleanup_s3 on it. With --baseline
+    the bucket is filled again and cleaned one object at a time for
+    comparison.
+
+    python benchmarks/bench_cleanup_s3.py --objects 20000
+
+    A moto S3 server is started unless --endpoint points at a running one.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+from multiprocessing.pool import ThreadPool
+
+import benchenv
+
+MB = 1024 * 1024
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--endpoint", help="URL of a running S3 stand-in")
+    parser.add_argument("--objects", type=int, default=20000, help="Number of build files in the bucket")
+    parser.add_argument("--refs", type=int, default=50, help="Number of refs in the index, each keeping one build")
+    parser.add_argument("--baseline", action="store_true", help="Also time deleting one object at a time")
+    args = parser.parse_args()
+
+    standin = None
+    if not args.endpoint:
+        standin, args.endpoint = benchenv.start_s3_standin()
+    config = benchenv.setup(**{"s3-endpoint": args.endpoint})
+    from serverdaemon import s3
+    from serverdaemon.catalog import parse_build_filename
+
+    # get_index() reads the index relative to the working folder
+    os.chdir(config.SCRATCH_FOLDER)
+    path = "ue4-builds/%s/WindowsServer/" % config.BUILD_PATH
+    index_folder = os.path.join("config", config.BUILD_PATH)
+    os.makedirs(index_folder)
+    refs = [{"ref": "users/bench/ref%d" % i, "target_platform": "WindowsServer",
+             "build_manifest": path + "game.users.bench.ref%d.%d.json" % (i, i)} for i in xrange(args.refs)]
+    with open(os.path.join(index_folder, "index.json"), "w") as f:
+        json.dump({"refs": refs}, f)
+
+    s3.get_bucket().connection.create_bucket(config.BUILD_BUCKET)
+
+    def populate():
+        def put(i):
+            s3.get_bucket().new_key(path + "game.users.bench.ref%d.%d.zip" % (i % args.refs, i)).set_contents_from_string("x" * 1024)
+        start_time = time.time()
+        pool = ThreadPool(16)
+        try:
+            pool.map(put, xrange(args.objects), chunksize=64)
+        finally:
+            pool.close()
+            pool.join()
+        print "Uploaded %s objects in %.1f seconds" % (args.objects, time.time() - start_time)
+
+    def cleanup_per_object():
+        # The cleanup loop cleanup_s3 replaced: one request per deleted file
+        catalog = s3.get_catalog()
+        for key in s3.get_bucket().list(prefix=path, delimiter="/"):
+            parsed = parse_build_filename(key.name.split("/")[-1])
+            if parsed and not catalog.has_build(parsed[1]):
+                key.delete()
+
+    try:
+        populate()
+        results = []
+        # Files uploaded just now count as old with max_days=-1
+        start_time = time.time()
+        summary = s3.cleanup_s3(dry_run=True, max_days=-1)
+        results.append(("cleanup_s3 dry run", time.time() - start_time, summary["deleted"]))
+        start_time = time.time()
+        summary = s3.cleanup_s3(max_days=-1)
+        results.append(("cleanup_s3", time.time() - start_time, summary["deleted"]))
+        if args.baseline:
+            populate()
+            start_time = time.time()
+            cleanup_per_object()
+            results.append(("per object delete", time.time() - start_time, summary["deleted"]))
+
+        print
+        print "%-24s %10s %10s %12s" % ("method", "seconds", "deleted", "objects/s")
+        for name, seconds, num_deleted in results:
+            print "%-24s %10.2f %10s %12.0f" % (name, seconds, num_deleted, args.objects / seconds)
+    finally:
+        os.chdir(benchenv.ROOT_PATH)
+        benchenv.teardown(config)
+        if standin:
+            standin.kill()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+    Drift game server management - Extraction benchmark
+    ------------------------------------------------
+    Compares the parallel extractor used by install_build with
+    ZipFile.extractall on a synthetic server build. The build store is off
+    so both write plain files. --build-store also times the extractor
+    adding the build to an empty build store.
+
+    python benchmarks/bench_extract.py --files 3000 --paks 3 --pak-mb 128 --threads 2,4,8
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+from zipfile import ZipFile
+
+import benchenv
+from buildgen import make_build_archive
+
+MB = 1024 * 1024
+
+
+def timed(fn, *args):
+    start_time = time.time()
+    fn(*args)
+    return time.time() - start_time
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=3000, help="Number of small files in the build")
+    parser.add_argument("--paks", type=int, default=3, help="Number of large pak files in the build")
+    parser.add_argument("--pak-mb", type=int, default=128, help="Size of each pak file in MB")
+    parser.add_argument("--threads", default="2,4,8", help="Comma separated thread counts to try")
+    parser.add_argument("--build-store", action="store_true", help="Also time extracting into the build store")
+    args = parser.parse_args()
+
+    config = benchenv.setup(**{"build-store": False})
+    from serverdaemon import syncbuilds
+    from serverdaemon.syncbuilds import extract_parallel
+
+    try:
+        zipfile_path = os.path.join(config.BSD_TEMP_FOLDER, "benchmark.game.1.zip")
+        print "Generating synthetic build with %s files and %s x %s MB paks..." % (args.files, args.paks, args.pak_mb)
+        total_size = make_build_archive(zipfile_path, args.files, args.paks, args.pak_mb)
+        print "Archive is %.0f MB, %.0f MB uncompressed" % (os.path.getsize(zipfile_path) / float(MB), total_size / float(MB))
+
+        dest_folder = os.path.join(config.BSD_BATTLESERVER_FOLDER, "benchmark")
+
+        def extractall():
+            with ZipFile(zipfile_path) as zipfile:
+                zipfile.extractall(dest_folder)
+
+        thread_counts = [int(t) for t in args.threads.split(",")]
+        results = [("extractall", timed(extractall))]
+        shutil.rmtree(dest_folder)
+        for num_threads in thread_counts:
+            results.append(("extract_parallel x%s" % num_threads, timed(extract_parallel, zipfile_path, dest_folder, num_threads)))
+            shutil.rmtree(dest_folder)
+        if args.build_store:
+            # Each run starts from an empty store so every file is hashed
+            # and added, as on the first install of a build
+            syncbuilds.BUILD_STORE = True
+            for num_threads in thread_counts:
+                results.append(("build store x%s" % num_threads, timed(extract_parallel, zipfile_path, dest_folder, num_threads)))
+                shutil.rmtree(dest_folder)
+                shutil.rmtree(config.BSD_BUILD_STORE_FOLDER)
+
+        baseline = results[0][1]
+        print
+        print "%-24s %10s %10s %8s" % ("method", "seconds", "MB/s", "speedup")
+        for name, seconds in results:
+            print "%-24s %10.2f %10.1f %7.2fx" % (name, seconds, total_size / float(MB) / seconds, baseline / seconds)
+    finally:
+        benchenv.teardown(config)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+    Drift game server management - Install pipeline benchmark
+    ------------------------------------------------
+    Publishes synthetic server builds of one ref to a local S3 stand-in and
+    times each stage of getting them onto the machine:
+    sync_index -> download_build -> install_build -> delete_old_builds.
+    With stream-install on, download_build and install_build are replaced
+    by a single stream_install_build stage.
+    For each stage it reports the time taken, throughput, peak disk usage
+    of the scratch folder and peak RSS of the process.
+
+    python benchmarks/bench_install.py --builds 2 --files 3000 --paks 3 --pak-mb 128
+    python benchmarks/bench_install.py --output results.json
+    python benchmarks/bench_install.py --compare results.json --tolerance 0.25
+
+    With --compare the script exits with code 1 if a stage got slower than
+    the results in the given file by more than the tolerance, so it can run
+    as a CI step. Config values can be overridden with --set, e.g.
+    --set build-store=false --set extract-concurrency=8, or
+    --set stream-install=true to time streaming installs.
+"""
+import os
+import sys
+import json
+import time
+import threading
+import argparse
+
+import psutil
+
+import benchenv
+from buildgen import make_build_archive
+
+MB = 1024 * 1024
+REF = "users/benchmark/main"
+SAMPLE_INTERVAL = 0.05
+
+
+class _Sampler(object):
+    """
+    Samples the size of a folder and the RSS of this process on a thread,
+    keeping the peak values since the last reset().
+    """
+    def __init__(self, folder):
+        self.folder = folder
+        self.process = psutil.Process(os.getpid())
+        self.disk_baseline = psutil.disk_usage(folder).used
+        self.stopped = threading.Event()
+        self.reset()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def reset(self):
+        self.peak_disk = 0
+        self.peak_rss = 0
+        self._sample()
+
+    def _sample(self):
+        self.peak_disk = max(self.peak_disk, psutil.disk_usage(self.folder).used - self.disk_baseline)
+        self.peak_rss = max(self.peak_rss, self.process.memory_info().rss)
+
+    def _run(self):
+        while not self.stopped.wait(SAMPLE_INTERVAL):
+            self._sample()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+def _parse_overrides(values):
+    overrides = {}
+    for value in values:
+        key, _, text = value.partition("=")
+        try:
+            overrides[key] = json.loads(text)
+        except ValueError:
+            overrides[key] = text
+    return overrides
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--endpoint", help="URL of a running S3 stand-in")
+    parser.add_argument("--builds", type=int, default=2, help="Number of consecutive builds of the ref to install")
+    parser.add_argument("--files", type=int, default=3000, help="Number of small files in each build")
+    parser.add_argument("--paks", type=int, default=3, help="Number of large pak files in each build")
+    parser.add_argument("--pak-mb", type=int, default=128, help="Size of each pak file in MB")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE", help="Override a config.json value")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="Fail if slower than the results in this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed slowdown with --compare, as a fraction")
+    args = parser.parse_args()
+
+    standin = None
+    if not args.endpoint:
+        standin, args.endpoint = benchenv.start_s3_standin()
+    overrides = _parse_overrides(args.set)
+    overrides["s3-endpoint"] = args.endpoint
+    config = benchenv.setup(**overrides)
+    sampler = None
+    try:
+        from serverdaemon import s3
+        from serverdaemon.syncbuilds import install_build, stream_install_build, STREAM_INSTALL
+        from serverdaemon.daemon import delete_old_builds
+
+        # The index and manifests are synced relative to the working folder
+        os.chdir(config.SCRATCH_FOLDER)
+        bucket = s3.get_bucket()
+        bucket.connection.create_bucket(config.BUILD_BUCKET)
+        build_folder = "ue4-builds/%s/WindowsServer/" % config.BUILD_PATH
+        archive_folder = os.path.join(config.SCRATCH_FOLDER, "archives")
+        os.makedirs(archive_folder)
+
+        builds = []
+        for build_number in xrange(1, args.builds + 1):
+            build_name = "game.%s.%s" % (REF.replace("/", "."), build_number)
+            archive = build_folder + build_name + ".zip"
+            filename = os.path.join(archive_folder, build_name + ".zip")
+            print "Generating and uploading build %s..." % build_name
+            total_size = make_build_archive(filename, args.files, args.paks, args.pak_mb, seed=build_number)
+            bucket.new_key(archive).set_contents_from_filename(filename)
+            manifest = {
+                "build": build_name,
+                "build_number": build_number,
+                "archive": archive,
+                "executable_path": "WindowsServer/Game/Binaries/Win64/GameServer.exe",
+            }
+            manifest_path = build_folder + build_name + ".json"
+            bucket.new_key(manifest_path).set_contents_from_string(json.dumps(manifest))
+            builds.append((manifest, manifest_path, os.path.getsize(filename), total_size))
+            os.remove(filename)
+
+        sampler = _Sampler(config.SCRATCH_FOLDER)
+        results = []
+
+        def stage(name, fn, num_bytes=0):
+            sampler.reset()
+            start_time = time.time()
+            value = fn()
+            seconds = time.time() - start_time
+            sampler._sample()
+            results.append({
+                "stage": name,
+                "seconds": round(seconds, 3),
+                "mb_per_second": round(num_bytes / float(MB) / max(seconds, 0.001), 1),
+                "peak_disk_mb": round(sampler.peak_disk / float(MB), 1),
+                "peak_rss_mb": round(sampler.peak_rss / float(MB), 1),
+            })
+            return value
+
+        for i, (manifest, manifest_path, archive_size, total_size) in enumerate(builds):
+            index = {"refs": [{"ref": REF, "target_platform": "WindowsServer", "build_manifest": manifest_path}]}
+            bucket.new_key("%s/index.json" % config.BUILD_PATH).set_contents_from_string(json.dumps(index))
+            suffix = " #%s" % (i + 1)
+            stage("sync_index" + suffix, s3.sync_index)
+            if STREAM_INSTALL:
+                stage("stream_install_build" + suffix, lambda: stream_install_build(manifest["archive"]), total_size)
+            else:
+                local_filename = stage("download_build" + suffix, lambda: s3.download_build(manifest["archive"]), archive_size)
+                stage("install_build" + suffix, lambda: install_build(local_filename), total_size)
+            stage("delete_old_builds" + suffix, delete_old_builds)
+    finally:
+        if sampler:
+            sampler.stop()
+        os.chdir(benchenv.ROOT_PATH)
+        benchenv.teardown(config)
+        if standin:
+            standin.kill()
+
+    print
+    print "%-24s %10s %10s %14s %12s" % ("stage", "seconds", "MB/s", "peak disk MB", "peak RSS MB")
+    for result in results:
+        print "%-24s %10.2f %10s %14.1f %12.1f" % (result["stage"], result["seconds"], result["mb_per_second"] or "",
+                                                   result["peak_disk_mb"], result["peak_rss_mb"])
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=4)
+
+    if args.compare:
+        with open(args.compare, "r") as f:
+            previous = dict((result["stage"], result) for result in json.load(f)["results"])
+        regressions = []
+        for result in results:
+            before = previous.get(result["stage"])
+            if before and result["seconds"] > before["seconds"] * (1.0 + args.tolerance):
+                regressions.append("%s: %.2f -> %.2f seconds" % (result["stage"], before["seconds"], result["seconds"]))
+        if regressions:
+            print
+            print "Regressions of more than %d%%:" % (args.tolerance * 100)
+            for regression in regressions:
+                print "  " + regression
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
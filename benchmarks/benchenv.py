@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+    Drift game server management - Benchmark environment
+    ------------------------------------------------
+    Lets serverdaemon code run on a developer machine or build agent.
+    serverdaemon.config looks up the tier, product and credentials from EC2
+    and drift config when it is imported, so setup() installs a stand-in with
+    fixed values whose storage folders all live in a scratch folder. If the
+    driftconfig package is not installed an empty stand-in is put in its
+    place as well, since nothing the benchmarks run looks anything up in it.
+
+    Call setup() before importing anything from serverdaemon.
+"""
+import os
+import sys
+import json
+import types
+import shutil
+import tempfile
+import time
+import socket
+import subprocess
+
+ROOT_PATH = os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+if ROOT_PATH not in sys.path:
+    sys.path.insert(0, ROOT_PATH)
+
+BENCHMARK_BUCKET = "benchmark-builds"
+BENCHMARK_PATH = "ue4-builds/benchmark/game"
+
+
+def setup(scratch_folder=None, **config_overrides):
+    """
+    Install the stand-in for serverdaemon.config and return it. Keyword
+    arguments override values from config/config.json, e.g.
+    setup(**{"s3-endpoint": "http://127.0.0.1:5000"}).
+    """
+    scratch_folder = scratch_folder or tempfile.mkdtemp(prefix="serverdaemon-bench-")
+
+    with open(os.path.join(ROOT_PATH, "config", "config.json")) as f:
+        config_file = json.load(f)
+    config_file.update(config_overrides)
+
+    config = types.ModuleType("serverdaemon.config")
+    config.config_file = config_file
+    config.SCRATCH_FOLDER = scratch_folder
+    config.TIER = "BENCHMARK"
+    config.BSD_TEMP_FOLDER = os.path.join(scratch_folder, "temp")
+    config.BSD_BATTLESERVER_FOLDER = os.path.join(scratch_folder, "builds")
+    config.BSD_LOGS_FOLDER = os.path.join(scratch_folder, "logs", "battleserver")
+    config.DAEMON_LOGS_FOLDER = os.path.join(scratch_folder, "logs", "drift-serverdaemon")
+    config.BSD_STATE_FOLDER = os.path.join(scratch_folder, "serverdaemon")
+    config.BSD_BUILD_STORE_FOLDER = os.path.join(scratch_folder, "buildstore")
+    config.product_name = "benchmark"
+    config.group_name = "benchmark"
+    config.region_name = "eu-west-1"
+    config.api_key = None
+    config.BUILD_BUCKET = BENCHMARK_BUCKET
+    config.BUILD_PATH = BENCHMARK_PATH
+    config.S3_REGION_NAME = "eu-west-1"
+    for folder in (config.BSD_TEMP_FOLDER, config.BSD_BATTLESERVER_FOLDER, config.BSD_LOGS_FOLDER,
+                   config.DAEMON_LOGS_FOLDER, config.BSD_STATE_FOLDER):
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+    sys.modules["serverdaemon.config"] = config
+    try:
+        import driftconfig.util
+    except ImportError:
+        _install_driftconfig_standin()
+    import serverdaemon
+    serverdaemon.config = config
+    import serverdaemon.logsetup as logsetup
+    logsetup.DAEMON_LOGS_FOLDER = config.DAEMON_LOGS_FOLDER
+
+    return config
+
+
+def _install_driftconfig_standin():
+    def get_domains():
+        raise RuntimeError("drift config is not available in benchmarks")
+    driftconfig = types.ModuleType("driftconfig")
+    driftconfig.util = types.ModuleType("driftconfig.util")
+    driftconfig.util.get_domains = get_domains
+    sys.modules["driftconfig"] = driftconfig
+    sys.modules["driftconfig.util"] = driftconfig.util
+
+
+def teardown(config):
+    shutil.rmtree(config.SCRATCH_FOLDER, ignore_errors=True)
+
+
+def start_s3_standin(port=5000, timeout=30):
+    """
+    Start moto's S3 server on 'port' as a local stand-in for S3 and return
+    the process and its endpoint URL. Needs the moto package.
+    """
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+    process = subprocess.Popen([sys.executable, "-m", "moto.server", "-p", str(port), "s3"],
+                               stdout=open(os.devnull, "w"), stderr=subprocess.STDOUT)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("S3 stand-in exited with code %s. Is moto installed?" % process.returncode)
+        try:
+            socket.create_connection(("127.0.0.1", port), 1.0).close()
+            return process, "http://127.0.0.1:%s" % port
+        except socket.error:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError("S3 stand-in did not start listening on port %s" % port)
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""
+    Drift game server management - Synthetic builds
+    ------------------------------------------------
+    Generates zip archives shaped like UE4 server builds for benchmarking:
+    thousands of small files in a folder tree plus a few large .pak files.
+"""
+import os
+import random
+from zipfile import ZipFile, ZIP_DEFLATED
+
+MB = 1024 * 1024
+
+
+def _make_data(rnd, size):
+    """
+    Half random, half repetitive bytes so the data compresses roughly like
+    game binaries do.
+    """
+    random_part = os.urandom(size // 2)
+    pattern = "".join(chr(rnd.randint(0, 255)) for i in xrange(64))
+    repeated_part = (pattern * (size // 128 + 1))[:size - len(random_part)]
+    return random_part + repeated_part
+
+
+def make_build_archive(filename, num_files=3000, num_paks=3, pak_mb=128, seed=0):
+    """
+    Write a synthetic server build to 'filename' and return its uncompressed
+    size in bytes. Small files are between 1 KB and 256 KB.
+    """
+    rnd = random.Random(seed)
+    total_size = 0
+    with ZipFile(filename, "w", ZIP_DEFLATED, allowZip64=True) as zipfile:
+        for i in xrange(num_files):
+            folder = "WindowsServer/Game/Binaries/Win64/Module%d/Sub%d" % (i % 40, i % 7)
+            size = rnd.randint(1024, 256 * 1024)
+            zipfile.writestr("%s/file%05d.dat" % (folder, i), _make_data(rnd, size))
+            total_size += size
+        for i in xrange(num_paks):
+            size = pak_mb * MB
+            zipfile.writestr("WindowsServer/Game/Content/Paks/Game-WindowsServer-%d.pak" % i, _make_data(rnd, size))
+            total_size += size
+        exe = _make_data(rnd, 20 * MB)
+        zipfile.writestr("WindowsServer/Game/Binaries/Win64/GameServer.exe", exe)
+        total_size += len(exe)
+    return total_size
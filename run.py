@@ -9,9 +9,9 @@ import time
 import traceback
 
 import serverdaemon.daemon as daemon
-from serverdaemon.s3 import get_manifest, sync_index, get_index, cleanup_s3
+from serverdaemon.s3 import get_manifest, sync_index, get_index, cleanup_s3, CLEANUP_MAX_DAYS
 from serverdaemon.cleanlogs import upload_logs
-from serverdaemon.utils import get_ts
+from serverdaemon.utils import get_ts, set_low_priority
 from serverdaemon.logsetup import setup_logging, logger, log_event
 from serverdaemon import logsetup
 import serverdaemon.config as config
@@ -19,6 +19,7 @@ from serverdaemon.config import config_file
 from serverdaemon.heartbeat import heartbeat_all_tenants
 from serverdaemon.syncbuilds import download_latest_builds
 from serverdaemon.runtasks import update_tasks
+from serverdaemon.supervisor import Supervisor
 
 def delete_old_builds():
     daemon.delete_old_builds()
@@ -43,16 +44,20 @@ def main():
     #parser_run.add_argument("-n", "--num-processes", help='Number of UE4 processes to run simultaneously. Overrides num-processes from config')
     parser_run.add_argument("-t", "--tenant", help='Backend tenant to connect to. Overrides tenant from config')
 
+    subparsers.add_parser('supervise', help='Run battleservers for all refs registered on this machine')
     subparsers.add_parser('clean', help='Delete old builds from the machine')
     subparsers.add_parser('cleanall', help='Delete all builds from the machine')
     subparsers.add_parser('cleanlogs', help='Clean logs and move to S3')
-    subparsers.add_parser('cleans3', help='Delete old builds from S3')
+    parser_cleans3 = subparsers.add_parser('cleans3', help='Delete old builds from S3')
+    parser_cleans3.add_argument("-n", "--dry-run", action="store_true", help='Report what would be deleted without deleting anything')
+    parser_cleans3.add_argument("-d", "--days", type=int, default=CLEANUP_MAX_DAYS, help='Only delete files older than this many days')
     subparsers.add_parser('heartbeat', help='Heartbeat this machine on all registered tenants')
     subparsers.add_parser('updateruntasks', help='Set up run tasks for all registered refs')
     
 
     parser_deploy = subparsers.add_parser('syncbuilds', help='Fetch and install the latest builds from S3')
     parser_deploy.add_argument("-f", "--force", action="store_true", help='Always download file (even if it already exists)')
+    parser_deploy.add_argument("-l", "--low-priority", action="store_true", help='Run at low CPU and I/O priority')
 
     args = parser.parse_args()
     logname = args.cmd
@@ -64,7 +69,7 @@ def main():
     logsetup.args_cmd = logname
 
     #! we have multiple ongoing run commands at once and we can't use the same logfile
-    if args.cmd in ("run"):
+    if args.cmd in ("run", "supervise"):
         logname = "%s_%s"  % (args.cmd, os.getpid())
     setup_logging(logname)
     if args.verbose:
@@ -93,7 +98,13 @@ def main():
         d.run()
         logger.info("Exiting")
 
+    elif args.cmd == "supervise":
+        Supervisor().run()
+        logger.info("Exiting")
+
     elif args.cmd == "syncbuilds":
+        if args.low_priority:
+            set_low_priority()
         download_latest_builds(args.force)
     elif args.cmd == "clean":
         delete_old_builds()
@@ -102,7 +113,7 @@ def main():
     elif args.cmd == "cleanlogs":
         upload_logs()
     elif args.cmd == "cleans3":
-        cleanup_s3()
+        cleanup_s3(args.dry_run, args.days)
     elif args.cmd == "heartbeat":
         heartbeat_all_tenants()
     elif args.cmd == "updateruntasks":
@@ -18,9 +18,10 @@ $minuteTrigger = New-ScheduledTaskTrigger -Once -At (Get-Date) -RepetitionInterv
 $dailyTrigger = New-ScheduledTaskTrigger -Daily -At 12am
 $startUpTrigger = New-ScheduledTaskTrigger -AtStartup
 
-# Get the latest battleserver builds from S3 every minute and update the local index file
+# Get the latest battleserver builds from S3 every minute and update the local index file.
+# Runs in the background while the servers keep running the current build.
 $name = 'Sync builds from S3'
-$cmd = "run.py syncbuilds"
+$cmd = "run.py syncbuilds --low-priority"
 Write-Output '*** Registering task '''$name''' with command '''$cmd''''
 
 Unregister-ScheduledTask -TaskName $name -TaskPath $taskPath -Confirm:$false -ErrorAction:SilentlyContinue  
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+    Drift game server management - Build Cache
+    ------------------------------------------------
+    Keeps the storage drive from filling up with builds. The build images in
+    BSD_BATTLESERVER_FOLDER and the zip files in BSD_TEMP_FOLDER are treated
+    as a cache: when free space drops below the low watermark the least
+    recently used entries are deleted until free space is back above the
+    high watermark.
+
+    A build is used when it is installed and when a daemon starts servers
+    from it. The times are kept in a JSON file shared by all serverdaemon
+    processes. Entries without a recorded time count as used when they were
+    last modified. Builds backing a running process are never deleted.
+"""
+import os
+import json
+import time
+import shutil
+from threading import Lock
+from contextlib import contextmanager
+
+import psutil
+
+import config
+from config import config_file
+from logsetup import logger, log_event
+from serverdaemon.utils import file_lock, free_disk_space, replace_file
+from buildstore import collect_garbage
+
+USAGE_FILENAME = os.path.join(config.BSD_STATE_FOLDER, "build_usage.json")
+LOCK_FILENAME = USAGE_FILENAME + ".lock"
+
+# Free space on the storage drive below which builds are evicted, and the
+# free space eviction stops at
+LOW_WATERMARK = config_file.get("cache-low-watermark-mb", 8192) * 1024 * 1024
+HIGH_WATERMARK = config_file.get("cache-high-watermark-mb", 16384) * 1024 * 1024
+
+# Suffixes of builds and downloads that are still being written
+IN_PROGRESS_SUFFIXES = (".temp", ".tmp", ".progress")
+
+# Partial downloads and installs not written to for this long have been
+# abandoned and are evicted like any other entry
+STALE_IN_PROGRESS_TIME = config_file.get("cache-stale-in-progress-hours", 24) * 3600
+
+# Names of builds being installed by this process
+_pinned = set()
+_evict_lock = Lock()
+
+
+@contextmanager
+def _usage_table():
+    with file_lock(LOCK_FILENAME):
+        table = {}
+        try:
+            with open(USAGE_FILENAME, "r") as f:
+                table = json.load(f)
+        except IOError:
+            pass
+        except ValueError as e:
+            logger.warning("Build usage file '%s' is corrupt. Starting over: %s", USAGE_FILENAME, e)
+        yield table
+        with open(USAGE_FILENAME + ".tmp", "w") as f:
+            json.dump(table, f)
+        replace_file(USAGE_FILENAME + ".tmp", USAGE_FILENAME)
+
+
+def touch_build(image_name):
+    """
+    Record that the build 'image_name' was used just now.
+    """
+    with _usage_table() as table:
+        table[image_name] = time.time()
+
+
+@contextmanager
+def pinned(image_name):
+    """
+    Keep the build 'image_name' and its zip file from being evicted while
+    it is installed.
+    """
+    with _evict_lock:
+        _pinned.add(image_name)
+    try:
+        yield
+    finally:
+        with _evict_lock:
+            _pinned.discard(image_name)
+
+
+def running_builds():
+    """
+    Return the names of the build images that running processes were
+    started from.
+    """
+    builds_folder = os.path.normcase(os.path.abspath(config.BSD_BATTLESERVER_FOLDER)) + os.path.sep
+    result = set()
+    for p in psutil.process_iter():
+        try:
+            exe = os.path.normcase(p.exe())
+        except (psutil.AccessDenied, psutil.NoSuchProcess, OSError):
+            continue
+        if exe.startswith(builds_folder):
+            result.add(exe[len(builds_folder):].split(os.path.sep)[0])
+    return result
+
+
+def _image_name(filename):
+    while filename.endswith(IN_PROGRESS_SUFFIXES):
+        filename = os.path.splitext(filename)[0]
+    if filename.endswith(".zip"):
+        return filename[:-len(".zip")]
+    return filename
+
+
+def _last_modified(path):
+    """
+    Return when 'path', or anything in it if it is a folder, was last
+    written to.
+    """
+    mtime = os.path.getmtime(path)
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            for name in dirs + files:
+                try:
+                    mtime = max(mtime, os.path.getmtime(os.path.join(root, name)))
+                except OSError:
+                    pass
+    return mtime
+
+
+def _list_entries():
+    """
+    Return (last used, image name, path) for each build image and zip file,
+    and for each partial download or install that has been abandoned.
+    """
+    entries = []
+    for folder in (config.BSD_BATTLESERVER_FOLDER, config.BSD_TEMP_FOLDER):
+        if not os.path.exists(folder):
+            continue
+        for filename in os.listdir(folder):
+            path = os.path.join(folder, filename)
+            if filename.endswith(IN_PROGRESS_SUFFIXES):
+                mtime = _last_modified(path)
+                if time.time() - mtime < STALE_IN_PROGRESS_TIME:
+                    continue
+            else:
+                mtime = os.path.getmtime(path)
+            entries.append((mtime, _image_name(filename), path))
+    with _usage_table() as table:
+        return [(max(table.get(image_name, 0), mtime), image_name, path) for mtime, image_name, path in entries]
+
+
+def _free_space():
+    return free_disk_space(config.BSD_BATTLESERVER_FOLDER)
+
+
+def ensure_free_space(needed=0):
+    """
+    Evict builds if the storage drive would have less than the low watermark
+    free after using 'needed' more bytes. Eviction stops once the high
+    watermark would be free, or when nothing more can be evicted.
+    """
+    with _evict_lock:
+        free_space = _free_space()
+        if free_space - needed >= LOW_WATERMARK:
+            return
+        logger.info("%.0f MB free on the storage drive and %.0f MB needed. Evicting builds...",
+                    free_space / 1024.0 / 1024.0, needed / 1024.0 / 1024.0)
+        start_free_space = free_space
+        protected = running_builds() | _pinned
+        evicted = []
+        for last_used, image_name, path in sorted(_list_entries()):
+            if free_space - needed >= HIGH_WATERMARK:
+                break
+            if image_name in protected:
+                continue
+            logger.info("Evicting '%s', last used %s", path, time.ctime(last_used))
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+                # Shared files are only freed once no build uses them
+                collect_garbage()
+            else:
+                os.remove(path)
+            evicted.append(os.path.basename(path))
+            free_space = _free_space()
+
+        with _usage_table() as table:
+            for image_name in table.keys():
+                if not os.path.exists(os.path.join(config.BSD_BATTLESERVER_FOLDER, image_name)):
+                    del table[image_name]
+
+        details = {
+            "evicted": evicted,
+            "protected": sorted(protected),
+            "bytes_freed": free_space - start_free_space,
+            "free_bytes": free_space,
+            "needed_bytes": needed,
+        }
+        if free_space - needed < LOW_WATERMARK:
+            logger.warning("Only %.0f MB free on the storage drive after evicting %s builds",
+                           free_space / 1024.0 / 1024.0, len(evicted))
+            log_event("build_cache_full", "Storage drive is still low on space after evicting %s builds" % len(evicted),
+                      details=details, severity="WARNING")
+        else:
+            log_event("build_cache_evicted", "Evicted %s builds" % len(evicted), details=details)
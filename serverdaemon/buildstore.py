@@ -0,0 +1,347 @@
+# -*- coding: utf-8 -*-
+"""
+    Drift game server management - Content Addressed Build Store
+    ------------------------------------------------
+    Consecutive builds of a ref, and the same build used by several refs,
+    share most of their files. Instead of writing every file of every build,
+    each unique file is kept once in the store under the SHA1 of its
+    contents and the build folders are trees of hard links into the store.
+
+    The store lives next to the build folders (hard links can't cross
+    volumes) and has four parts:
+        objects/ab/<sha1>    - file contents
+        builds/<image>.json  - the files and hashes of each installed build
+        hints/<crc>-<size>   - the sha1 of large files with that CRC and size
+        tmp/                 - objects being written
+
+    An object is garbage once no installed build lists it. Deleting it only
+    removes the store's name for the file; builds linking to it are fine.
+    Files under a 'Saved' folder are written by the servers at runtime so
+    they are always copied, never linked.
+"""
+import os
+import sys
+import json
+import shutil
+import hashlib
+import uuid
+import time
+import collections
+
+import config
+from logsetup import logger, log_event
+from serverdaemon.utils import replace_file
+
+OBJECTS_FOLDER = os.path.join(config.BSD_BUILD_STORE_FOLDER, "objects")
+BUILDS_FOLDER = os.path.join(config.BSD_BUILD_STORE_FOLDER, "builds")
+HINTS_FOLDER = os.path.join(config.BSD_BUILD_STORE_FOLDER, "hints")
+TMP_FOLDER = os.path.join(config.BSD_BUILD_STORE_FOLDER, "tmp")
+
+# Members up to this size are hashed in memory before anything is written.
+# Larger ones are looked up by the CRC and size in the zip directory. If
+# that points to an object in the store the member is only hashed to
+# confirm it, otherwise it is hashed while it is written to a temporary file.
+MAX_IN_MEMORY_SIZE = 8 * 1024 * 1024
+IO_BUFFER_SIZE = 1024 * 1024
+# Objects younger than this are never collected. A build being installed by
+# another process uses its objects before its listing is registered.
+GC_GRACE_SECONDS = 60 * 60
+
+
+def _makedirs(folder):
+    try:
+        os.makedirs(folder)
+    except OSError:
+        if not os.path.isdir(folder):
+            raise
+
+
+def hard_link(src, dst):
+    if sys.platform == "win32":
+        import ctypes
+        if not ctypes.windll.kernel32.CreateHardLinkW(unicode(dst), unicode(src), None):
+            raise ctypes.WinError()
+    else:
+        os.link(src, dst)
+
+
+def object_path(digest):
+    return os.path.join(OBJECTS_FOLDER, digest[:2], digest)
+
+
+def has_object(digest):
+    return os.path.exists(object_path(digest))
+
+
+def discard_object(digest):
+    """
+    Remove a damaged object from the store so it is written again by the
+    next build that has it.
+    """
+    try:
+        os.remove(object_path(digest))
+    except OSError:
+        pass
+
+
+def member_path(member, folder):
+    """
+    Return where ZipFile.extract would put 'member' in 'folder'. Absolute
+    paths and '..' components are stripped the same way. 'member' is a
+    ZipInfo or a file name in the archive.
+    """
+    arcname = getattr(member, "filename", member).replace("/", os.path.sep)
+    if os.path.altsep:
+        arcname = arcname.replace(os.path.altsep, os.path.sep)
+    arcname = os.path.splitdrive(arcname)[1]
+    arcname = os.path.sep.join(x for x in arcname.split(os.path.sep)
+                               if x not in ("", os.path.curdir, os.path.pardir))
+    return os.path.join(folder, arcname)
+
+
+def _new_tmp_path():
+    _makedirs(TMP_FOLDER)
+    return os.path.join(TMP_FOLDER, uuid.uuid4().hex)
+
+
+def _add_object(digest, write):
+    """
+    Add an object to the store. 'write(f)' writes its contents to the open
+    file 'f'. Another thread adding the same object at the same time is fine.
+    """
+    tmp_path = _new_tmp_path()
+    with open(tmp_path, "wb") as f:
+        write(f)
+    _store_tmp_file(tmp_path, digest)
+
+
+def _store_tmp_file(tmp_path, digest):
+    """
+    Move the file 'tmp_path' into the store as the object 'digest'.
+    """
+    path = object_path(digest)
+    _makedirs(os.path.dirname(path))
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        os.remove(tmp_path)
+        if not os.path.exists(path):
+            raise
+
+
+def _hint_path(member):
+    return os.path.join(HINTS_FOLDER, "%08x-%d" % (member.CRC & 0xffffffff, member.file_size))
+
+
+def _get_hint(member):
+    """
+    Return the digest last seen for a member with the CRC and size of
+    'member', or None.
+    """
+    try:
+        with open(_hint_path(member), "r") as f:
+            return f.read().strip() or None
+    except IOError:
+        return None
+
+
+def _set_hint(member, digest):
+    _makedirs(HINTS_FOLDER)
+    tmp_path = _new_tmp_path()
+    with open(tmp_path, "w") as f:
+        f.write(digest)
+    replace_file(tmp_path, _hint_path(member))
+
+
+def _hash_member(zipfile, member):
+    sha1 = hashlib.sha1()
+    with zipfile.open(member) as src:
+        for data in iter(lambda: src.read(IO_BUFFER_SIZE), b""):
+            sha1.update(data)
+    return sha1.hexdigest()
+
+
+def link_object(digest, target_path):
+    """
+    Make 'target_path' a hard link to the object 'digest'. Falls back to a
+    copy if the object can't take more links (NTFS allows 1023).
+    """
+    _makedirs(os.path.dirname(target_path))
+    try:
+        hard_link(object_path(digest), target_path)
+    except OSError as e:
+        if not has_object(digest):
+            raise
+        logger.warning("Could not link '%s' to object %s. Copying instead: %s", target_path, digest, e)
+        shutil.copyfile(object_path(digest), target_path)
+
+
+def is_stored(member):
+    """
+    Return True if 'member' is kept in the store rather than extracted.
+    """
+    return (not member.filename.endswith("/") and member.file_size > 0 and
+            "/Saved/" not in "/" + member.filename)
+
+
+def link_member(member, folder, digest):
+    """
+    Put 'member' into 'folder' by linking to the object 'digest' without
+    reading the archive. Returns a listing entry for the file, or None if
+    the object is not in the store.
+    """
+    if not is_stored(member) or not has_object(digest):
+        return None
+    link_object(digest, member_path(member, folder))
+    return {"sha1": digest, "size": member.file_size, "new": False}
+
+
+def _add_large_member(zipfile, member):
+    """
+    Add 'member' of 'zipfile' to the store, hashing it while it is written.
+    Returns its digest and whether it was new.
+    """
+    # One pass over the member, which may be streamed from S3
+    sha1 = hashlib.sha1()
+    tmp_path = _new_tmp_path()
+    try:
+        with zipfile.open(member) as src, open(tmp_path, "wb") as f:
+            for data in iter(lambda: src.read(IO_BUFFER_SIZE), b""):
+                sha1.update(data)
+                f.write(data)
+        digest = sha1.hexdigest()
+        is_new = not has_object(digest)
+        if is_new:
+            _store_tmp_file(tmp_path, digest)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return digest, is_new
+
+
+def extract_member(zipfile, member, folder):
+    """
+    Extract 'member' of 'zipfile' into 'folder' as a hard link into the
+    store, adding its contents to the store if they are new. Returns a
+    listing entry for the file, or None if it was not stored.
+    """
+    target_path = member_path(member, folder)
+    if member.filename.endswith("/"):
+        _makedirs(target_path)
+        return None
+    if not is_stored(member):
+        _makedirs(os.path.dirname(target_path))
+        zipfile.extract(member, folder)
+        return None
+
+    if member.file_size <= MAX_IN_MEMORY_SIZE:
+        data = zipfile.read(member)
+        digest = hashlib.sha1(data).hexdigest()
+        is_new = not has_object(digest)
+        if is_new:
+            _add_object(digest, lambda f: f.write(data))
+    else:
+        digest = _get_hint(member)
+        if digest and has_object(digest) and _hash_member(zipfile, member) == digest:
+            is_new = False
+        else:
+            digest, is_new = _add_large_member(zipfile, member)
+            _set_hint(member, digest)
+
+    link_object(digest, target_path)
+    return {"sha1": digest, "size": member.file_size, "new": is_new}
+
+
+def register_build(image_name, listing):
+    """
+    Record which objects the installed build 'image_name' uses. 'listing'
+    maps file names in the archive to entries from extract_member().
+    """
+    _makedirs(BUILDS_FOLDER)
+    listing = dict((name, {"sha1": entry["sha1"], "size": entry["size"]}) for name, entry in listing.iteritems())
+    filename = os.path.join(BUILDS_FOLDER, image_name + ".json")
+    with open(filename + ".tmp", "w") as f:
+        json.dump(listing, f)
+    replace_file(filename + ".tmp", filename)
+
+
+def get_build_listing(image_name):
+    """
+    Return the listing of an installed build, or None if it wasn't
+    installed through the store.
+    """
+    try:
+        with open(os.path.join(BUILDS_FOLDER, image_name + ".json"), "r") as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def collect_garbage():
+    """
+    Delete the objects that no installed build uses any more. Listings of
+    builds that have been removed from BSD_BATTLESERVER_FOLDER go first.
+    """
+    if not os.path.exists(OBJECTS_FOLDER):
+        return
+    refcounts = collections.Counter()
+    if os.path.exists(BUILDS_FOLDER):
+        for filename in os.listdir(BUILDS_FOLDER):
+            image_name, ext = os.path.splitext(filename)
+            if ext != ".json":
+                continue
+            listing_path = os.path.join(BUILDS_FOLDER, filename)
+            if not os.path.exists(os.path.join(config.BSD_BATTLESERVER_FOLDER, image_name)):
+                logger.info("Build '%s' is no longer installed. Releasing its objects", image_name)
+                os.remove(listing_path)
+                continue
+            for entry in get_build_listing(image_name).itervalues():
+                refcounts[entry["sha1"]] += 1
+
+    num_deleted = 0
+    bytes_freed = 0
+    grace_time = time.time() - GC_GRACE_SECONDS
+    for prefix in os.listdir(OBJECTS_FOLDER):
+        prefix_folder = os.path.join(OBJECTS_FOLDER, prefix)
+        for digest in os.listdir(prefix_folder):
+            if refcounts[digest]:
+                continue
+            path = os.path.join(prefix_folder, digest)
+            try:
+                st = os.stat(path)
+                if st.st_mtime > grace_time:
+                    continue
+                size = st.st_size
+                os.remove(path)
+            except OSError as e:
+                logger.warning("Could not delete object '%s': %s", path, e)
+                continue
+            num_deleted += 1
+            bytes_freed += size
+
+    # Hints to deleted objects would only cost a lookup, but don't let
+    # them pile up
+    if os.path.exists(HINTS_FOLDER):
+        for filename in os.listdir(HINTS_FOLDER):
+            path = os.path.join(HINTS_FOLDER, filename)
+            try:
+                with open(path, "r") as f:
+                    digest = f.read().strip()
+                if not has_object(digest):
+                    os.remove(path)
+            except (IOError, OSError):
+                pass
+
+    # Files still being written by other installs are left alone
+    if os.path.exists(TMP_FOLDER):
+        for filename in os.listdir(TMP_FOLDER):
+            path = os.path.join(TMP_FOLDER, filename)
+            try:
+                if os.path.getmtime(path) < grace_time:
+                    os.remove(path)
+            except OSError:
+                pass
+    if num_deleted:
+        logger.info("Deleted %s unused objects from the build store, freeing %.0f MB", num_deleted, bytes_freed / 1024.0 / 1024.0)
+        log_event("build_store_gc", "Deleted %s unused objects from the build store" % num_deleted,
+                  details={"objects": num_deleted, "bytes": bytes_freed})
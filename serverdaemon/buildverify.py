@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+    Drift game server management - Build Verification
+    ------------------------------------------------
+    Checks installed builds against the listing of their files recorded in
+    the build store, so a build that was partly extracted or has been
+    damaged since is caught before servers crash on it.
+
+    Files are hashed in parallel and large paks through mmap. Hashes are
+    cached by path, size and mtime so checking an unchanged build again
+    only takes a stat of each file. Builds that fail are moved aside to a
+    quarantine folder so the next sync installs them again.
+"""
+import os
+import json
+import mmap
+import time
+import random
+import shutil
+import hashlib
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
+import config
+from config import config_file
+from logsetup import logger, log_event
+from serverdaemon.utils import file_lock, replace_file
+import buildstore
+from buildcache import running_builds
+
+CACHE_FILENAME = os.path.join(config.BSD_STATE_FOLDER, "verify_cache.json")
+LOCK_FILENAME = CACHE_FILENAME + ".lock"
+QUARANTINE_FOLDER = os.path.join(config.BSD_STATE_FOLDER, "quarantine")
+
+# Number of threads hashing files
+VERIFY_CONCURRENCY = config_file.get("verify-concurrency", 4)
+# Number of files checked each time an installed build is looked at again.
+# All files are checked right after install.
+VERIFY_SAMPLE_SIZE = config_file.get("verify-sample-size", 200)
+# Files at least this large are hashed through mmap
+MMAP_THRESHOLD = 16 * 1024 * 1024
+IO_BUFFER_SIZE = 1024 * 1024
+# Number of quarantined builds kept for inspection
+MAX_QUARANTINED = 3
+
+
+@contextmanager
+def _hash_cache():
+    with file_lock(LOCK_FILENAME):
+        cache = {}
+        try:
+            with open(CACHE_FILENAME, "r") as f:
+                cache = json.load(f)
+        except IOError:
+            pass
+        except ValueError as e:
+            logger.warning("Verification cache '%s' is corrupt. Starting over: %s", CACHE_FILENAME, e)
+        yield cache
+        with open(CACHE_FILENAME + ".tmp", "w") as f:
+            json.dump(cache, f)
+        replace_file(CACHE_FILENAME + ".tmp", CACHE_FILENAME)
+
+
+def hash_file(path, size):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        if size >= MMAP_THRESHOLD:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for offset in xrange(0, size, MMAP_THRESHOLD):
+                    sha1.update(m[offset:offset + MMAP_THRESHOLD])
+            finally:
+                m.close()
+        else:
+            for data in iter(lambda: f.read(IO_BUFFER_SIZE), b""):
+                sha1.update(data)
+    return sha1.hexdigest()
+
+
+def verify_build(image_name, sample_size=None):
+    """
+    Check the files of the installed build 'image_name' against its listing.
+    If 'sample_size' is given only that many files, picked at random, are
+    checked. Returns a list of (file name, problem) for the files that
+    don't match, or None if the build has no listing to check against.
+    """
+    listing = buildstore.get_build_listing(image_name)
+    if listing is None:
+        return None
+    build_folder = os.path.join(config.BSD_BATTLESERVER_FOLDER, image_name)
+    filenames = listing.keys()
+    if sample_size and sample_size < len(filenames):
+        filenames = random.sample(filenames, sample_size)
+
+    start_time = time.time()
+    with _hash_cache() as cache:
+        cached = dict(cache)
+
+    def check(filename):
+        entry = listing[filename]
+        path = buildstore.member_path(filename, build_folder)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return filename, "missing", None
+        if st.st_size != entry["size"]:
+            return filename, "size %s != %s" % (st.st_size, entry["size"]), None
+        cache_entry = cached.get(path)
+        if cache_entry and cache_entry[:2] == [st.st_size, st.st_mtime]:
+            digest = cache_entry[2]
+            cache_entry = None
+        else:
+            digest = hash_file(path, st.st_size)
+            cache_entry = [st.st_size, st.st_mtime, digest]
+        if digest != entry["sha1"]:
+            return filename, "sha1 %s != %s" % (digest, entry["sha1"]), None
+        return None, path, cache_entry
+
+    pool = ThreadPool(VERIFY_CONCURRENCY)
+    try:
+        results = pool.map(check, filenames, chunksize=16)
+    finally:
+        pool.close()
+        pool.join()
+
+    failures = [(filename, problem) for filename, problem, cache_entry in results if filename]
+    new_entries = dict((path, cache_entry) for filename, path, cache_entry in results if cache_entry)
+    if new_entries:
+        with _hash_cache() as cache:
+            # Drop entries of builds that are gone
+            for path in cache.keys():
+                if not os.path.exists(path):
+                    del cache[path]
+            cache.update(new_entries)
+
+    logger.info("Verified %s of %s files of build '%s' in %.1f seconds. %s hashed, %s failed", len(filenames),
+                len(listing), image_name, time.time() - start_time, len(new_entries), len(failures))
+    return failures
+
+
+def quarantine_build(image_name, failures):
+    """
+    Move the installed build 'image_name' out of BSD_BATTLESERVER_FOLDER so
+    it gets installed again. The store objects of the files that failed are
+    discarded as well since build files are links to them.
+    """
+    listing = buildstore.get_build_listing(image_name) or {}
+    for filename, problem in failures:
+        if filename in listing:
+            buildstore.discard_object(listing[filename]["sha1"])
+
+    if not os.path.exists(QUARANTINE_FOLDER):
+        os.makedirs(QUARANTINE_FOLDER)
+    build_folder = os.path.join(config.BSD_BATTLESERVER_FOLDER, image_name)
+    dest_folder = os.path.join(QUARANTINE_FOLDER, "%s.%d" % (image_name, time.time()))
+    logger.error("Build '%s' failed verification on %s files. Moving it to %s", image_name, len(failures), dest_folder)
+    os.rename(build_folder, dest_folder)
+    log_event("build_quarantined", "Build '%s' failed verification" % image_name,
+              details={"build": image_name, "failures": failures[:20], "num_failures": len(failures)},
+              severity="ERROR")
+
+    quarantined = sorted(os.listdir(QUARANTINE_FOLDER), key=lambda f: os.path.getmtime(os.path.join(QUARANTINE_FOLDER, f)))
+    for folder in quarantined[:-MAX_QUARANTINED]:
+        shutil.rmtree(os.path.join(QUARANTINE_FOLDER, folder), ignore_errors=True)
+
+
+def check_build(image_name, sample_size=None):
+    """
+    Verify the installed build 'image_name' and quarantine it if it fails.
+    Returns False if it was quarantined. A build that servers are running
+    from can't be moved, so it is left in place and quarantined by a later
+    check once the servers are gone.
+    """
+    failures = verify_build(image_name, sample_size)
+    if failures:
+        if sample_size:
+            # Find every damaged file so none of their objects stay in the store
+            failures = verify_build(image_name)
+        if image_name in running_builds():
+            logger.error("Build '%s' failed verification on %s files but servers are running from it. Leaving it in place",
+                         image_name, len(failures))
+            log_event("build_damaged_in_use", "Build '%s' failed verification while in use" % image_name,
+                      details={"build": image_name, "failures": failures[:20], "num_failures": len(failures)},
+                      severity="ERROR")
+            return True
+        quarantine_build(image_name, failures)
+        return False
+    return True
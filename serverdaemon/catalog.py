@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+    Drift game server management - Build Catalog
+    ------------------------------------------------
+    Indexes over the refs in index.json so lookups by ref, build number and
+    platform, and matching local build folders and zip files to their refs,
+    don't scan the whole index each time.
+
+    Build images, zip files and manifests are named after the ref they were
+    built from and the build number, e.g. 'game.users.bob.feature.1234' for
+    build 1234 of ref 'users/bob/feature', with '.zip' or '.json' appended.
+"""
+import collections
+
+
+def ref_to_filename(ref):
+    return ref.replace("/", ".")
+
+
+def parse_build_filename(filename):
+    """
+    Split a build image, zip file or manifest name into its dot separated
+    parts before the build number, and the build number. Returns None if
+    the name has no build number.
+    """
+    parts = filename.split(".")
+    for i in (len(parts) - 2, len(parts) - 1):
+        if i > 0:
+            try:
+                return parts[:i], int(parts[i])
+            except ValueError:
+                pass
+    return None
+
+
+class BuildCatalog(object):
+    """
+    Read-only indexes over the parsed 'index_file'. Entries are the ref
+    items from the index: {"ref", "target_platform", "build_manifest", ...}.
+    """
+    def __init__(self, index_file):
+        self.index_file = index_file
+        self.by_ref = collections.OrderedDict()
+        self.by_ref_and_platform = {}
+        self.by_build_number = collections.defaultdict(list)
+        self.by_platform = collections.defaultdict(list)
+        self.by_ref_filename = {}
+        for entry in index_file["refs"]:
+            ref = entry["ref"]
+            self.by_ref.setdefault(ref, []).append(entry)
+            # The first entry wins, like the linear scans this replaces
+            self.by_ref_and_platform.setdefault((ref, entry["target_platform"]), entry)
+            self.by_platform[entry["target_platform"]].append(entry)
+            self.by_ref_filename.setdefault(ref_to_filename(ref), ref)
+            parsed = parse_build_filename(entry["build_manifest"].split("/")[-1])
+            if parsed:
+                self.by_build_number[parsed[1]].append(entry)
+
+    def find(self, ref, target_platform=None):
+        """
+        Return the entry for 'ref' on 'target_platform', or the first entry
+        for 'ref' on any platform. Returns None if there is none.
+        """
+        if target_platform:
+            return self.by_ref_and_platform.get((ref, target_platform))
+        entries = self.by_ref.get(ref)
+        return entries[0] if entries else None
+
+    def has_build(self, build_number):
+        """
+        Return True if some ref in the index points at 'build_number'.
+        """
+        return build_number in self.by_build_number
+
+    def oldest_build_numbers(self, target_platform, ref_prefix=""):
+        """
+        Return {ref: build number} with the lowest build number the index has
+        for each ref on 'target_platform' starting with 'ref_prefix'.
+        """
+        result = {}
+        for entry in self.by_platform.get(target_platform, []):
+            if not entry["ref"].startswith(ref_prefix):
+                continue
+            parsed = parse_build_filename(entry["build_manifest"].split("/")[-1])
+            if parsed:
+                build_number = parsed[1]
+                result[entry["ref"]] = min(result.get(entry["ref"], build_number), build_number)
+        return result
+
+    def match_filename(self, filename):
+        """
+        Find the ref a local build folder or zip file belongs to. Returns a
+        tuple of (ref, build number), or None if the name matches no ref in
+        the index.
+        """
+        parsed = parse_build_filename(filename)
+        if not parsed:
+            return None
+        parts, build_number = parsed
+        # The product name in front may itself contain dots so try every
+        # suffix, longest first
+        for i in xrange(len(parts)):
+            ref = self.by_ref_filename.get(".".join(parts[i:]))
+            if ref is not None:
+                return ref, build_number
+        return None
@@ -25,6 +25,11 @@ BSD_BATTLESERVER_FOLDER = STORAGE_DRIVE + ":/builds"
 BSD_LOGS_FOLDER =  STORAGE_DRIVE + ":/logs/battleserver"
 # Serverdaemon log folder
 DAEMON_LOGS_FOLDER =  STORAGE_DRIVE + ":/logs/drift-serverdaemon"
+# Machine-wide state shared by all serverdaemon processes
+BSD_STATE_FOLDER = STORAGE_DRIVE + ":/serverdaemon"
+# Content addressed store shared by the build images. Must be on the same
+# drive as BSD_BATTLESERVER_FOLDER.
+BSD_BUILD_STORE_FOLDER = STORAGE_DRIVE + ":/buildstore"
 
 tags = get_tags()
 product_name = tags.get("drift-product_name")
@@ -24,85 +24,121 @@ import psutil
 import requests
 
 from logsetup import logger, log_event
-from s3 import get_index
+from s3 import get_catalog
 from config import config_file
 from rest import RESTResource, ServerResource, get_auth_token, get_battle_api, get_machine_resource, get_root_endpoint
 
+from reactor import Reactor
+from ports import lease_port, assign_port, release_port
+from buildstore import collect_garbage
+from buildcache import touch_build
+from procregistry import register_process, unregister_process, find_processes, terminate_processes, is_ref_scanned, mark_ref_scanned
+
 import sys
 from subprocess import PIPE, Popen
-from threading  import Thread
+from threading import Lock
+from multiprocessing.pool import ThreadPool
 
-from serverdaemon.s3 import get_manifest
+from serverdaemon.s3 import get_manifest, is_build_installed
 from serverdaemon.utils import update_state, get_num_processes
 
-try:
-    from Queue import Queue, Empty
-except ImportError:
-    from queue import Queue, Empty  # python 3.x
-
 # Battleserver UDP port range
 MIN_PORT = 7777
 MAX_PORT = 8000
 
+# Seconds between checks of processes_per_machine and the build index
+CONFIG_CHECK_INTERVAL = 5.0
+# Seconds between polls of each started server for commands and heartbeat
+SERVER_CHECK_INTERVAL = 10.0
+# Seconds before a dead server is replaced. Each failure to start or crash
+# in a row doubles the delay, up to RESPAWN_MAX_DELAY.
+RESPAWN_DELAY = 5.0
+RESPAWN_MAX_DELAY = config_file.get("respawn-max-delay", 300)
+# After this many failures within CIRCUIT_BREAKER_WINDOW seconds no servers
+# are spawned for CIRCUIT_BREAKER_OPEN_SECONDS. Then a single server is
+# started to probe whether the problem is gone.
+CIRCUIT_BREAKER_FAILURES = config_file.get("circuit-breaker-failures", 5)
+CIRCUIT_BREAKER_WINDOW = config_file.get("circuit-breaker-window", 600)
+CIRCUIT_BREAKER_OPEN_SECONDS = config_file.get("circuit-breaker-open-seconds", 600)
+# Number of battleservers that may be spawned in parallel
+SPAWN_CONCURRENCY = config_file.get("spawn-concurrency", 4)
+# Only the REST calls of a spawn run in parallel. On Windows a child
+# inherits every inheritable handle open at the time, so a server started
+# while another one's stdout pipe is being set up holds that pipe open
+# and its exit would go unnoticed until both have exited.
+_popen_lock = Lock()
+# Number of threads making REST calls and waiting on processes for a daemon,
+# so a slow backend or process doesn't hold up the reactor shared by all
+# daemons. Kept apart from the spawn pool so slow spawns don't delay polls.
+BACKGROUND_CONCURRENCY = config_file.get("background-concurrency", 8)
+# Ramp-up limit: how many servers may be in 'starting' state at once,
+# including the ones still being spawned
+MAX_STARTING_SERVERS = config_file.get("max-starting-servers", 4)
+# Seconds a server may take to reach 'started'
+START_TIMEOUT = 60.0
+# Seconds without a heartbeat before a server is considered frozen
+HEARTBEAT_TIMEOUT = 60.0
+# Replace the servers one by one when a new build is available, instead of
+# shutting them all down at once
+ROLLING_UPGRADES = config_file.get("rolling-upgrades", True)
+# How many servers may run above 'num_processes' during a rolling upgrade
+UPGRADE_SURGE = config_file.get("upgrade-surge", 2)
+# Seconds old servers in a match may keep running after an upgrade starts
+UPGRADE_DRAIN_TIMEOUT = config_file.get("upgrade-drain-timeout", 1800)
+# Number of started servers kept idle on top of the ones in a match, so a
+# match can start without waiting for a server to boot. The pool only grows
+# the number of servers beyond 'num_processes' when the machine is near
+# capacity, and by no more than this.
+WARM_POOL_SIZE = config_file.get("warm-pool-size", 0)
+# Seconds between reports of the warm pool metrics
+WARM_POOL_METRICS_INTERVAL = 300.0
+
 def delete_all_builds():
     shutil.rmtree(config.BSD_BATTLESERVER_FOLDER, ignore_errors=True)
     shutil.rmtree(config.BSD_TEMP_FOLDER, ignore_errors=True)
+    shutil.rmtree(config.BSD_BUILD_STORE_FOLDER, ignore_errors=True)
 
 def delete_old_builds():
     """
     deletes all 'user' builds that do not match the current build_number
     Currently leaves other refs alone
     """
-    def extract_build_from_filename(filename):
-        lst = filename.split(".")
-        try:
-            return int(lst[-2])
-        except ValueError:
-            return int(lst[-1])
     repo = config.BUILD_PATH
     logger.info("Deleting old user builds for repo '%s'...", repo)
-    index_file = get_index()
-    build_folders = os.listdir(config.BSD_BATTLESERVER_FOLDER)
-    zip_files = os.listdir(config.BSD_TEMP_FOLDER)
-    build_number_by_ref = {}
+    catalog = get_catalog()
+    build_number_by_ref = catalog.oldest_build_numbers("WindowsServer", "users/")
+    for ref_name, latest_build_number in build_number_by_ref.iteritems():
+        logger.debug("Latest build for ref '%s' is %s", ref_name, latest_build_number)
     num_deleted_folders = 0
     num_deleted_files = 0
-    for ref in index_file["refs"]:
-        ref_name = ref["ref"]
-        target_platform = ref["target_platform"]
-        if ref_name.startswith("users/") and target_platform == "WindowsServer":
-            build_number = extract_build_from_filename(ref["build_manifest"])
-            if ref_name in build_number_by_ref:
-                build_number_by_ref[ref_name] = min(build_number_by_ref[ref_name], build_number)
-            else:
-                build_number_by_ref[ref_name] = build_number
 
-    for ref_name, latest_build_number in build_number_by_ref.iteritems():
-        logger.debug("Latest build for ref '%s' is %s", ref_name, latest_build_number)
-        ref_filename = ref_name.replace("/", ".")
-        for folder in build_folders:
-            if ref_filename in folder:
-                this_build_number = extract_build_from_filename(folder)
-                if this_build_number < latest_build_number:
-                    folder = os.path.join(config.BSD_BATTLESERVER_FOLDER, folder)
-                    logger.info("Deleting folder '%s' for ref '%s' because %s < %s", folder, ref_name, this_build_number, latest_build_number)
-                    shutil.rmtree(folder)
-                    num_deleted_folders += 1
-
-        for filename in zip_files:
-            if ref_filename in filename:
-                this_build_number = extract_build_from_filename(filename)
-                if this_build_number < latest_build_number:
-                    filename = os.path.join(config.BSD_TEMP_FOLDER, filename)
-                    logger.info("Deleting zip file '%s' for ref '%s' because %s < %s", filename, ref_name, this_build_number, latest_build_number)
-                    os.remove(filename)
-                    num_deleted_files += 1
+    def is_old(filename):
+        match = catalog.match_filename(filename)
+        if not match or match[0] not in build_number_by_ref:
+            return False
+        ref_name, this_build_number = match
+        if this_build_number < build_number_by_ref[ref_name]:
+            logger.info("Deleting '%s' for ref '%s' because %s < %s", filename, ref_name, this_build_number, build_number_by_ref[ref_name])
+            return True
+        return False
+
+    for folder in os.listdir(config.BSD_BATTLESERVER_FOLDER):
+        if is_old(folder):
+            shutil.rmtree(os.path.join(config.BSD_BATTLESERVER_FOLDER, folder))
+            num_deleted_folders += 1
+
+    for filename in os.listdir(config.BSD_TEMP_FOLDER):
+        if is_old(filename):
+            os.remove(os.path.join(config.BSD_TEMP_FOLDER, filename))
+            num_deleted_files += 1
 
     if any((num_deleted_folders, num_deleted_files)):
         logger.info("Deleted %s build folders and %s zip files", num_deleted_folders, num_deleted_files)
     else:
         logger.info("No old builds to delete")
 
+    collect_garbage()
+
 
 def _get_logfolder():
     if not os.path.exists(config.BSD_LOGS_FOLDER):
@@ -111,49 +147,56 @@ def _get_logfolder():
     return config.BSD_LOGS_FOLDER
 
 
-def _get_available_port(min_port, max_port):
-    """Find an unused UPD port number."""
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-
-    for i in xrange(250):
-        port_no = min_port + i
-        try:
-            sock.bind(('', port_no))
-            sock.close()
-            return port_no
-        except socket.error:
-            pass
-
-    raise RuntimeError(
-        "Exhausted trying to find available UPD port number in the range "
-        "of %s to %s." % (min_port, max_port)
-        )
-
-def kill_processes_by_ref(ref, tenant):
-    """"
-    Find all running processes of any version of 'ref' and terminate
+def _scan_processes(ref, tenant):
+    """
+    Find the processes of any version of 'ref' by looking at every process
+    on the machine. Only needed for servers started before there was a
+    process registry.
     """
-    logger.info("kill_processes_by_ref '%s', '%s'", ref, tenant)
-    repo = config.BUILD_PATH
     build_info = get_manifest(ref)
-    executable_path = build_info["executable_path"].lower()
+    if build_info is None:
+        return []
     partial_build = build_info["build"].replace(str(build_info["build_number"]), "").lower()
     logger.info("  Finding partial path '%s'..." % partial_build)
-    killed_processes = []
-    #! TODO: tenant is not included so this kills all tasks in this ref for all tenants. Fix me!
+    processes = []
     for p in psutil.process_iter():
         try:
             exe = p.exe().replace("\\", "/").lower()
             cmd = p.cmdline()
-        except psutil.AccessDenied:
-            logger.debug("  Got AccessDenied for '%s'" % p.name())
+        except (psutil.AccessDenied, psutil.NoSuchProcess):
             continue
-
         if partial_build in exe and ("-tenant=%s" % tenant) in cmd:
-            killed_processes.append({'pid': p.pid, 'exe': exe, 'cmd': cmd})
-            logger.info("  Killing pid %s: '%s'", p.pid, p.exe())
-            p.terminate()
-            p.wait(timeout=10)
+            processes.append(p)
+    return processes
+
+def _scan_unregistered(ref, tenant, registered):
+    """
+    Return the battleservers of 'ref' for 'tenant' that are running but not
+    in 'registered', the processes found in the registry
+    """
+    pids = set(p.pid for p in registered)
+    return [p for p in _scan_processes(ref, tenant) if p.pid not in pids]
+
+def kill_processes_by_ref(ref, tenant):
+    """
+    Terminate all running battleservers of any version of 'ref' for 'tenant'
+    """
+    logger.info("kill_processes_by_ref '%s', '%s'", ref, tenant)
+    # Entries of the processes are dropped the next time it is searched
+    processes = [p for p, entry in find_processes(ref, tenant)]
+    scanned = is_ref_scanned(ref, tenant)
+    if not scanned:
+        processes += _scan_unregistered(ref, tenant, processes)
+    killed_processes = []
+    for p in processes:
+        try:
+            killed_processes.append({'pid': p.pid, 'exe': p.exe(), 'cmd': p.cmdline()})
+        except (psutil.AccessDenied, psutil.NoSuchProcess):
+            killed_processes.append({'pid': p.pid})
+        logger.info("  Killing pid %s", p.pid)
+    terminate_processes(processes)
+    if not scanned:
+        mark_ref_scanned(ref, tenant)
 
     if len(killed_processes):
         log_event('processes_killed', 
@@ -164,14 +207,226 @@ def kill_processes_by_ref(ref, tenant):
 
     logger.info("Done killing processes for ref='%s', tenant='%s'. Killed %s processes", ref, tenant, len(killed_processes))
 
-def find_build_manifest(index_file, ref):
-    for r in index_file["refs"]:
-        if r["ref"] == ref:
-            return r["build_manifest"]
+def _is_executable_installed(build_info):
+    executable = os.path.join(config.BSD_BATTLESERVER_FOLDER, build_info["build"], build_info["executable_path"])
+    return os.path.exists(executable)
+
+def _registered_build(ref, tenant):
+    """
+    Return the build info of the build the latest registered server of 'ref'
+    for 'tenant' was started from. Returns None if there are no registered
+    servers or their build is not installed.
+    """
+    entries = [entry for p, entry in find_processes(ref, tenant) if entry.get("build_info")]
+    if not entries:
+        return None
+    entry = max(entries, key=lambda e: e["create_time"])
+    if not _is_executable_installed(entry["build_info"]):
+        return None
+    return entry["build_info"]
+
+def find_build_manifest(ref):
+    entry = get_catalog().find(ref)
+    if entry:
+        return entry["build_manifest"]
     return -1
 
+# Lifecycle of a battleserver and the states it may move to from each one.
+# A 'pending' server is being spawned on the spawn pool and has no process
+# yet, so it is only counted in Daemon._num_spawning. A server is 'started'
+# once the game engine is initialized, 'running' while it is in a match and
+# 'draining' while it finishes its match before being retired.
+SERVER_TRANSITIONS = {
+    "pending": ("starting", "exited"),
+    "starting": ("started", "exited"),
+    "started": ("running", "draining", "exited"),
+    "running": ("started", "draining", "exited"),
+    "draining": ("exited",),
+    "exited": (),
+}
+
+class BattleServer(object):
+    """
+    Book-keeping for a single battleserver process spawned by the daemon.
+    """
+    def __init__(self, process, resource, port, build, state="starting"):
+        self.process = process
+        self.pid = process.pid
+        self.resource = resource
+        self.port = port
+        self.build = build
+        self.state = state
+        self.start_time = time.time()
+        # Reactor timers of this server by name
+        self.timers = {}
+        # When the server reached 'started' and its status on the backend as
+        # last polled
+        self.ready_time = None
+        self.resource_status = None
+
+    def __str__(self):
+        return "BattleServer pid=%s build=%s state=%s %s" % (self.pid, self.build, self.state, self.resource)
+
+    def set_state(self, state):
+        if state not in SERVER_TRANSITIONS[self.state]:
+            raise RuntimeError("%s cannot go to state '%s'" % (self, state))
+        logger.debug("%s -> %s", self, state)
+        self.state = state
+
+    def set_timer(self, name, timer):
+        """
+        Keep track of the reactor timer 'timer', replacing the one with the
+        same 'name'.
+        """
+        if name in self.timers:
+            self.timers[name].cancel()
+        self.timers[name] = timer
+
+    def cancel_timers(self):
+        for timer in self.timers.itervalues():
+            timer.cancel()
+        self.timers = {}
+
+    def terminate(self):
+        try:
+            psutil.Process(self.pid).terminate()
+        except psutil.NoSuchProcess:
+            pass
+
+class SpawnBreaker(object):
+    """
+    Rate limits spawning for a ref whose servers keep failing. Failures in a
+    row back off exponentially with jitter, and too many failures in a short
+    window open the circuit: nothing is spawned until the open period is
+    over, then one probe server is let through. If it starts up the circuit
+    closes again, otherwise it stays open for another period.
+    """
+    def __init__(self, ref, tenant):
+        self.ref = ref
+        self.tenant = tenant
+        self.state = "closed"
+        self.failures = collections.deque()
+        self.consecutive_failures = 0
+        self.next_attempt = 0
+        # Set while a probe server is starting up in the half-open state
+        self.probe_deadline = None
+
+    def record_failure(self, reason):
+        now = time.time()
+        self.consecutive_failures += 1
+        self.failures.append(now)
+        while self.failures and self.failures[0] < now - CIRCUIT_BREAKER_WINDOW:
+            self.failures.popleft()
+        if self.state == "half-open":
+            logger.warning("Probe server for ref '%s' failed: %s. Spawning stays suspended", self.ref, reason)
+            self._open(now)
+        elif self.state == "closed" and len(self.failures) >= CIRCUIT_BREAKER_FAILURES:
+            logger.error("Servers for ref '%s' failed %s times in %s seconds. Suspending spawning", self.ref, len(self.failures), CIRCUIT_BREAKER_WINDOW)
+            txt = "Spawning servers for ref '%s' suspended after %s failures in %s seconds. Last failure: %s" % (self.ref, len(self.failures), CIRCUIT_BREAKER_WINDOW, reason)
+            log_event("circuit_breaker_open", txt, details={"failures": len(self.failures), "reason": reason}, severity="ERROR", ref=self.ref, tenant_name=self.tenant)
+            self._open(now)
+        elif self.state == "closed":
+            delay = min(RESPAWN_MAX_DELAY, RESPAWN_DELAY * 2 ** (self.consecutive_failures - 1))
+            self.next_attempt = now + delay * random.uniform(0.5, 1.0)
+            logger.warning("Server for ref '%s' failed %s times in a row: %s. Next spawn in %.0f seconds", self.ref, self.consecutive_failures, reason, self.next_attempt - now)
+
+    def _open(self, now):
+        self.state = "open"
+        self.probe_deadline = None
+        self.next_attempt = now + CIRCUIT_BREAKER_OPEN_SECONDS
+
+    def record_success(self):
+        self.consecutive_failures = 0
+        if self.state != "closed":
+            logger.info("Probe server for ref '%s' started up. Resuming spawning", self.ref)
+            log_event("circuit_breaker_closed", "Spawning servers for ref '%s' resumed" % self.ref, ref=self.ref, tenant_name=self.tenant)
+            self.state = "closed"
+            self.failures.clear()
+            self.probe_deadline = None
+
+    def time_to_wait(self):
+        """
+        Seconds until servers may be spawned again.
+        """
+        next_attempt = self.next_attempt
+        if self.state == "half-open" and self.probe_deadline:
+            next_attempt = max(next_attempt, self.probe_deadline)
+        return max(0.0, next_attempt - time.time())
+
+    def max_spawns(self, num_wanted):
+        """
+        How many of 'num_wanted' servers may be spawned now.
+        """
+        if self.time_to_wait() > 0:
+            return 0
+        if self.state == "open":
+            logger.info("Spawning a probe server for ref '%s'", self.ref)
+            self.state = "half-open"
+        if self.state == "half-open":
+            # A probe that was killed by us never reports back, so another one
+            # is let through once it should have either started or timed out
+            self.probe_deadline = time.time() + START_TIMEOUT + 2 * SERVER_CHECK_INTERVAL
+            return min(num_wanted, 1)
+        return num_wanted
+
+def _poll_resource(resource):
+    """
+    Fetch the state of a server from its REST resource and acknowledge its
+    pending commands. Runs on a background thread.
+    """
+    resp = resource.get().json()
+    for cmd in resp["pending_commands"]:
+        logger.warning("I should execute the following command: '%s'", cmd["command"])
+        command_resource = copy.copy(resource)
+        command_resource.location = cmd["url"]
+        command_resource.patch(data={"status": "running"})
+    return resp
+
+def _get_statuses(resources):
+    """
+    Fetch the status of each resource in {pid: resource}. Runs on a
+    background thread. Servers whose status can't be fetched are left out.
+    """
+    statuses = {}
+    for pid, resource in resources.iteritems():
+        try:
+            statuses[pid] = resource.get_status()
+        except Exception as e:
+            logger.warning("Could not get status of %s: %s", resource, e)
+    return statuses
+
+def _report_exit(resource):
+    """
+    Mark the resource of a server that exited on its own, unless the server
+    updated the status itself. Returns the status it had. Runs on a
+    background thread.
+    """
+    resource_status = resource.get_status()
+    if resource_status == "starting":
+        resource.set_status("abnormalexit", {"status-reason": "Failed to start"})
+    elif resource_status == "running":
+        resource.set_status("abnormalexit", {"status-reason": "Died prematurely"})
+    return resource_status
+
+def reactor_callback(f):
+    """
+    Decorator for Daemon methods that are invoked by the reactor. Errors shut
+    down the servers of the failing daemon only, so other daemons sharing the
+    reactor keep running. Callbacks for a daemon that has stopped are ignored.
+    """
+    @wraps(f)
+    def wrapper(self, *args):
+        if self.stopped:
+            return
+        try:
+            return f(self, *args)
+        except Exception as e:
+            # unhandled exception
+            logger.exception("Fatal error occurred in run_battleserver_loop. Exiting")
+            self.shutdown_servers_and_exit("Fatal error, '%s' occurred in run_battleserver_loop" % e)
+    return wrapper
+
 class Daemon(object):
-    battleserver_instances = {}
     ref = None
     tenant = None
     num_processes = None
@@ -179,43 +434,132 @@ class Daemon(object):
     def __init__(self, ref, tenant):
         self.ref = ref
         self.tenant = tenant
+        self.battleserver_instances = {}
+        self.reactor = None
+        self.on_exit = None
+        self.stopped = False
+        self._reconcile_timer = None
+        self._spawn_pool = None
+        self._background_pool = None
+        self._adopting = False
+        self._fetching_statuses = False
+        self._checking_config = False
+        self._num_spawning = 0
+        self._num_added = 0
+        self._pending_manifest = None
+        self._upgrade_start_time = None
+        self._pool_hits = 0
+        self._cold_starts = 0
+        self._idle_seconds = 0.0
+        self.breaker = SpawnBreaker(ref, tenant)
         self.num_processes = get_num_processes(ref, tenant)
-        # kill old processes which have not been cleaned up correctly
-        kill_processes_by_ref(self.ref, self.tenant)
         logger.info("Daemon starting on ref '%s' with tenant '%s' and %d processes", self.ref, self.tenant, self.num_processes)
 
 
-    def shutdown_servers_and_exit(self, message=""):
+    def shutdown_servers_and_exit(self, message="", wait=False):
+        """
+        Kill all servers of the ref and stop the daemon. A daemon hosted by
+        the supervisor does the killing in the background and exits once it
+        is done, unless 'wait' is set.
+        """
+        if self.stopped:
+            return
         logger.warning("Shutting down because: '%s'" % message)
-        log_event("shutdown_servers", "Shutting down all servers because: '%s'" % message, severity="WARNING")
-        kill_processes_by_ref(self.ref, self.tenant)
-        for pid, (q, battleserver_resource, status) in self.battleserver_instances.iteritems():
-            battleserver_resource.set_status("killed", {"status-reason": message})
-        sys.exit(1)
+        log_event("shutdown_servers", "Shutting down all servers because: '%s'" % message, severity="WARNING", ref=self.ref, tenant_name=self.tenant)
+        servers = self.battleserver_instances.values()
+        self.battleserver_instances = {}
+        for server in servers:
+            server.cancel_timers()
+
+        def kill_all():
+            kill_processes_by_ref(self.ref, self.tenant)
+            for server in servers:
+                try:
+                    server.resource.set_status("killed", {"status-reason": message})
+                except Exception as e:
+                    logger.error("Could not update status of %s: %s", server, e)
+
+        if self.on_exit is None or wait:
+            kill_all()
+            self.exit(1)
+        else:
+            # Callbacks are ignored from here on
+            self.stopped = True
+            self.run_in_background(kill_all, (), lambda result: self.exit(1))
+
+    def exit(self, code):
+        """
+        Stop the daemon. A standalone daemon exits the process with 'code',
+        a daemon hosted by the supervisor hands control back to it.
+        """
+        if self.on_exit is None:
+            sys.exit(code)
+        logger.info("Daemon for ref '%s' with tenant '%s' exiting with code %s", self.ref, self.tenant, code)
+        self.stopped = True
+        if self._spawn_pool:
+            self._spawn_pool.close()
+        if self._background_pool:
+            self._background_pool.close()
+        self.on_exit(self)
+
+    def run_in_background(self, fn, args, callback=None, callback_args=()):
+        """
+        Run 'fn(*args)' on the background pool and pass its result to
+        'callback(*callback_args, result)' on the reactor thread. See
+        Reactor.run_in_pool().
+        """
+        self.reactor.run_in_pool(self._background_pool, fn, args, callback, callback_args)
+
+    def fetch_statuses(self, servers, callback):
+        """
+        Fetch the current status of 'servers' from the backend in the
+        background and pass {pid: status} to 'callback'. Only one fetch runs
+        at a time. Returns False if one is already running.
+        """
+        if self._fetching_statuses:
+            return False
+        self._fetching_statuses = True
+        resources = dict((s.pid, s.resource) for s in servers)
+        self.run_in_background(_get_statuses, (resources,), callback)
+        return True
+
+    def _status_of(self, server, statuses):
+        """
+        The status of 'server' in 'statuses', or as of its last poll.
+        """
+        if server.pid in statuses:
+            return statuses[server.pid]
+        return "running" if server.state in ("running", "draining") else server.state
 
     def start_battleserver(self):
+        """
+        Register a server resource and launch the battleserver process.
+        Returns the Popen object, the server resource, its port and the name of
+        the build. Runs on a spawn worker thread so it must not touch the
+        daemon state.
+        """
         repo = config.BUILD_PATH
-        build_info = get_manifest(self.ref)
-        def enqueue_output(out, queue):
-            for line in iter(out.readline, b''):
-                queue.put(line)
-            queue.put("ProcessExit")
-            out.close()
+        # The build this daemon was started on, even if the index has moved on
+        build_info = self.build_info
 
         #! get command line from config
         command_line = config_file["command-line"]
         build_path = build_info["build"]
         executable_path = build_info["executable_path"]
-        command, battleserver_resource = get_battleserver_command(build_path, executable_path, command_line, self.tenant)
+        command, battleserver_resource, port, log_file = get_battleserver_command(build_path, executable_path, command_line, self.tenant)
 
         logger.debug("Spawning process with command: %s", command)
 
         try:
-            p = subprocess.Popen(command, stdout=subprocess.PIPE, bufsize=1)
+            with _popen_lock:
+                p = subprocess.Popen(command, stdout=subprocess.PIPE, bufsize=1)
         except Exception as e:
             logger.exception("Spawning failed.")
+            release_port(port)
             battleserver_resource.set_status("popen failed", {"error": str(e)})
             raise
+        assign_port(port, p.pid)
+        register_process(p.pid, self.ref, self.tenant, build_info, port, battleserver_resource.location, log_file)
 
         pid = p.pid
 
@@ -233,199 +577,578 @@ class Daemon(object):
                 "details": {"ref": self.ref, "repository": repo, "build_path": build_path}
                 })
         logger.info("Spawned process with pid %s" % pid)
-        q = Queue()
-        t = Thread(target=enqueue_output, args=(p.stdout, q))
-        t.daemon = True # thread dies with the program
-        t.start()
-        return pid, q, battleserver_resource
-
-    def run(self):
+        return p, battleserver_resource, port, build_path
 
+    def _spawn_battleserver(self):
         try:
+            p, battleserver_resource, port, build = self.start_battleserver()
+        except Exception as e:
+            logger.exception("Failed to start battleserver")
+            self.reactor.call_soon_threadsafe(self.on_spawn_failed, e)
+        else:
+            self.reactor.call_soon_threadsafe(self.on_server_spawned, p, battleserver_resource, port, build)
+
+    def spawn_servers(self):
+        """
+        Start as many of the missing servers as the ramp-up limit allows.
+        The spawns run in parallel on the spawn pool. Only servers on the
+        current build count, but during a rolling upgrade no more than
+        UPGRADE_SURGE servers are run on top of 'num_processes'.
+        """
+        num_current = len([s for s in self.battleserver_instances.itervalues() if s.build == self.build_info["build"]])
+        num_wanted = self.num_wanted()
+        num_missing = num_wanted - num_current - self._num_spawning
+        num_missing = min(num_missing, num_wanted + UPGRADE_SURGE - len(self.battleserver_instances) - self._num_spawning)
+        if num_missing <= 0:
+            return
+        num_starting = self._num_spawning + len([s for s in self.battleserver_instances.itervalues() if s.state == "starting"])
+        num_to_spawn = min(num_missing, MAX_STARTING_SERVERS - num_starting)
+        if num_to_spawn <= 0:
+            logger.debug("%s servers are starting up. Waiting before adding %s more", num_starting, num_missing)
+            return
+        num_to_spawn = self.breaker.max_spawns(num_to_spawn)
+        if num_to_spawn <= 0:
+            if self.breaker.time_to_wait() > 0:
+                self.schedule_reconcile(self.breaker.time_to_wait())
+            return
+        logger.info("I am running %s battleservers but should be running %s. Adding %s servers..." % (len(self.battleserver_instances), num_wanted, num_to_spawn))
+        for i in xrange(num_to_spawn):
+            self._num_spawning += 1
+            self._spawn_pool.apply_async(self._spawn_battleserver)
+
+    @reactor_callback
+    def on_server_spawned(self, p, battleserver_resource, port, build):
+        self._num_spawning -= 1
+        server = BattleServer(p, battleserver_resource, port, build)
+        self.battleserver_instances[server.pid] = server
+        server.set_timer("start", self.reactor.call_later(START_TIMEOUT, self.on_start_timeout, server.pid))
+        self.reactor.watch_process(p, self.on_server_output, self.on_server_exit)
+        self._num_added += 1
+        if len(self.battleserver_instances) >= self.num_wanted() and not self._num_spawning:
+            logger.info("Done adding servers. Running instances: %s" % ",".join([str(p) for p in self.battleserver_instances.keys()]))
+            txt = "Done adding servers for ref '%s'. Added %s servers and am now running %s servers" % (self.ref, self._num_added, len(self.battleserver_instances))
+            log_event("servers_added", txt, ref=self.ref, tenant_name=self.tenant)
+            self._num_added = 0
+        else:
+            self.schedule_reconcile()
+
+    @reactor_callback
+    def on_spawn_failed(self, e):
+        self._num_spawning -= 1
+        self.breaker.record_failure("Spawning failed: %s" % e)
+        self.schedule_reconcile()
+
+    def kill_server(self, pid, status, reason):
+        """
+        Terminate the server running as 'pid' and report 'status' on its resource.
+        The server is forgotten immediately; its exit notification is ignored.
+        """
+        server = self.battleserver_instances.pop(pid)
+        server.cancel_timers()
+        server.set_state("exited")
+        self.run_in_background(server.resource.set_status, (status, {"status-reason": reason}))
+        server.terminate()
+        self.run_in_background(release_port, (server.port,))
+        return server
+
+    def num_wanted(self):
+        """
+        The number of servers to run: 'num_processes', plus enough to keep
+        WARM_POOL_SIZE idle servers next to the ones in a match.
+        """
+        num_busy = len([s for s in self.battleserver_instances.itervalues() if s.state in ("running", "draining")])
+        return min(self.num_processes + WARM_POOL_SIZE, max(self.num_processes, num_busy + WARM_POOL_SIZE))
+
+    def update_resource_status(self, server, resource_status):
+        """
+        Record the status of 'server' on the backend and move it between
+        'started' and 'running' as it goes in and out of matches. A server
+        going into a match was claimed either from the pool, if it had been
+        waiting for longer than one poll, or right after booting, which means
+        a match was waiting on a cold start. A draining server is retired
+        once its match is over.
+        """
+        server.resource_status = resource_status
+        is_busy = resource_status == "running"
+        if server.state == "draining":
+            if not is_busy:
+                logger.info("%s has finished its match. Retiring it", server)
+                self.kill_server(server.pid, "killed", "Replaced by build '%s'" % self.build_info["build"])
+                self.schedule_reconcile()
+            return
+        if is_busy == (server.state == "running"):
+            return
+        if is_busy:
+            idle_seconds = time.time() - (server.ready_time or time.time())
+            if idle_seconds > SERVER_CHECK_INTERVAL:
+                self._pool_hits += 1
+            else:
+                self._cold_starts += 1
+            self._idle_seconds += idle_seconds
+            server.set_state("running")
+        else:
+            server.set_state("started")
+        # Refill the pool, or shrink it when a match is over
+        self.schedule_reconcile()
+
+    @reactor_callback
+    def report_pool_metrics(self):
+        self.reactor.call_later(WARM_POOL_METRICS_INTERVAL, self.report_pool_metrics)
+        num_claims = self._pool_hits + self._cold_starts
+        if not num_claims:
+            return
+        servers = self.battleserver_instances.values()
+        details = {
+            "warm_pool_size": WARM_POOL_SIZE,
+            "servers": len(servers),
+            "busy": len([s for s in servers if s.state in ("running", "draining")]),
+            "idle": len([s for s in servers if s.state == "started"]),
+            "pool_hits": self._pool_hits,
+            "cold_starts": self._cold_starts,
+            "hit_rate": round(self._pool_hits / float(num_claims), 3),
+            "mean_idle_seconds": round(self._idle_seconds / num_claims, 1),
+        }
+        txt = "%s of %s servers for ref '%s' were claimed from the warm pool" % (self._pool_hits, num_claims, self.ref)
+        log_event("warm_pool_metrics", txt, details=details, ref=self.ref, tenant_name=self.tenant)
+        self._pool_hits = 0
+        self._cold_starts = 0
+        self._idle_seconds = 0.0
+
+    def schedule_reconcile(self, delay=0):
+        """
+        Make sure the number of running servers is brought in line with
+        'num_processes' within 'delay' seconds. Waiting out the backoff of the
+        circuit breaker is left to spawn_servers() so it doesn't hold back
+        scaling down or upgrading.
+        """
+        if self._reconcile_timer is not None:
+            if self._reconcile_timer.when <= time.time() + delay:
+                return
+            self._reconcile_timer.cancel()
+        self._reconcile_timer = self.reactor.call_later(delay, self.reconcile)
+
+    @reactor_callback
+    def reconcile(self):
+        self._reconcile_timer = None
+        if self._adopting:
+            # Reconciled once the servers from before a restart are known
+            return
+        old_servers = [s for s in self.battleserver_instances.itervalues() if s.build != self.build_info["build"]]
+        if old_servers:
+            self.roll_servers(old_servers)
+            return
+        if self._upgrade_start_time is not None:
+            txt = "Rolling upgrade of ref '%s' to build '%s' done in %.0f seconds" % (self.ref, self.build_info["build"], time.time() - self._upgrade_start_time)
+            logger.info(txt)
+            log_event("upgrade_complete", txt, ref=self.ref, tenant_name=self.tenant)
+            self._upgrade_start_time = None
+        if len(self.battleserver_instances) > self.num_wanted():
+            # Servers in a match are only killed if there is no other way
+            self.fetch_statuses(self.battleserver_instances.values(), self.scale_down)
+        else:
+            self.spawn_servers()
+
+    @reactor_callback
+    def scale_down(self, statuses):
+        self._fetching_statuses = False
+        statuses = statuses or {}
+        servers_killed = []
+        while len(self.battleserver_instances) > self.num_wanted():
+            logger.info("I am running %s battleservers but should be running %s. Killing servers..." % (len(self.battleserver_instances), self.num_wanted()))
+            # try to find a server that is not 'running'. If no such servers are found then kill a running one
+            for pid, server in self.battleserver_instances.items():
+                resource_status = self._status_of(server, statuses)
+                if resource_status != "running":
+                    logger.info("Found battleserver in state '%s' to kill: %s" % (resource_status, server.resource))
+                    pid_to_kill = pid
+                    break
+            else:
+                logger.warning("Found no battleserver to kill that was not 'running'. I will kill a running one")
+                pid_to_kill = self.battleserver_instances.keys()[0]
+
+            logger.info("Killing server with pid %s" % pid_to_kill)
+            self.kill_server(pid_to_kill, "killed", "Scaling down")
+            servers_killed.append(str(pid_to_kill))
+        if servers_killed:
+            txt = "Done killing servers for ref '%s'. Killed servers %s and am now running %s servers" % (self.ref, ", ".join(servers_killed), len(self.battleserver_instances))
+            log_event("servers_killed", txt, ref=self.ref, tenant_name=self.tenant)
+
+    def start_upgrade(self, build_info, build_manifest):
+        """
+        Switch to the installed build 'build_info' without shutting down. New
+        servers are started on it and the old ones are retired as the new
+        ones come up. See roll_servers().
+        """
+        old_build = self.build_info["build"]
+        self.build_info = build_info
+        self.build_manifest = build_manifest
+        self._pending_manifest = None
+        self._upgrade_start_time = time.time()
+        self.run_in_background(touch_build, (build_info["build"],))
+        txt = "Rolling upgrade of ref '%s' from build '%s' to '%s'" % (self.ref, old_build, build_info["build"])
+        logger.info(txt)
+        log_event("upgrade_started", txt, ref=self.ref, tenant_name=self.tenant)
+        self.schedule_reconcile()
+
+    def roll_servers(self, old_servers):
+        """
+        One step of a rolling upgrade. New servers are spawned up to the
+        surge limit, and for every new server that has started an old one is
+        retired, idle ones first. Old servers in a match are left draining
+        until the match is over or UPGRADE_DRAIN_TIMEOUT has passed.
+        """
+        serving = [s for s in old_servers if s.state != "draining"]
+        if serving and self.num_to_retire(serving) > 0:
+            # Which old servers are in a match is checked with the backend
+            self.fetch_statuses(serving, self.retire_servers)
+        self.spawn_servers()
+        # The next step is triggered by new servers starting up and old ones
+        # going away. The reconcile after the last one has gone finishes the
+        # upgrade.
+
+    def num_to_retire(self, serving):
+        num_started = len([s for s in self.battleserver_instances.itervalues()
+                           if s.build == self.build_info["build"] and s.state in ("started", "running")])
+        return num_started + len(serving) - self.num_wanted()
+
+    @reactor_callback
+    def retire_servers(self, statuses):
+        """
+        Retire as many old servers as new ones have taken over.
+        """
+        self._fetching_statuses = False
+        statuses = statuses or {}
+        serving = [s for s in self.battleserver_instances.itervalues()
+                   if s.build != self.build_info["build"] and s.state != "draining"]
+        num_to_retire = self.num_to_retire(serving)
+        if num_to_retire > 0:
+            serving.sort(key=lambda s: self._status_of(s, statuses) == "running")
+            for server in serving[:num_to_retire]:
+                if self._status_of(server, statuses) == "running" and server.state != "starting":
+                    logger.info("%s is in a match. Letting it finish before retiring it", server)
+                    server.set_state("draining")
+                    server.set_timer("drain", self.reactor.call_later(UPGRADE_DRAIN_TIMEOUT, self.on_drain_timeout, server.pid))
+                else:
+                    logger.info("Retiring %s", server)
+                    self.kill_server(server.pid, "killed", "Replaced by build '%s'" % self.build_info["build"])
+        # Retired servers make room for more new ones
+        self.schedule_reconcile()
+
+    @reactor_callback
+    def on_drain_timeout(self, pid):
+        server = self.battleserver_instances.get(pid)
+        if server is None or server.state != "draining":
+            return
+        logger.warning("%s is still in a match after %s seconds. Killing it", server, UPGRADE_DRAIN_TIMEOUT)
+        self.kill_server(pid, "killed", "Upgrade drain timeout")
+        self.schedule_reconcile()
+
+    @reactor_callback
+    def check_config(self):
+        """
+        Pick up changes to the number of processes and the build for this ref.
+        """
+        self.reactor.call_later(CONFIG_CHECK_INTERVAL, self.check_config)
+        if self._checking_config:
+            return
+        self._checking_config = True
+        self.run_in_background(self.load_config, (self.build_manifest,), self.on_config_loaded)
+
+    def load_config(self, build_manifest):
+        """
+        Look up the number of processes and the build manifest for this ref.
+        If the manifest is not 'build_manifest' its build info, or None if
+        the ref is gone from the index, and whether the build is installed
+        are looked up as well. Runs on a background thread.
+        """
+        num_processes = get_num_processes(self.ref, self.tenant)
+        new_manifest = find_build_manifest(self.ref)
+        build_info = None
+        installed = False
+        if new_manifest != build_manifest:
             build_info = get_manifest(self.ref)
-            build_path = build_info["build"]
-
-            index_file = get_index()
+            # Verifying the build reads its files
+            installed = build_info is not None and is_build_installed(build_info["build"], build_info["executable_path"])
+        return num_processes, new_manifest, build_info, installed
+
+    @reactor_callback
+    def on_config_loaded(self, result):
+        self._checking_config = False
+        if result is None:
+            # Logged by run_in_background. Tried again on the next check.
+            return
+        config_num_processes, new_manifest, build_info, installed = result
+        if config_num_processes != self.num_processes:
+            txt = "Number of processes in config for ref '%s' has changed from %s to %s" % (self.ref, self.num_processes, config_num_processes)
+            logger.warning(txt)
+            log_event("num_processes_changed", txt, ref=self.ref, tenant_name=self.tenant)
+            # if we should run more processes: no problem, we'll add them in automatically
+            # but if we should run fewer processes we need to kill some
+            self.num_processes = config_num_processes
+            self.schedule_reconcile()
+
+        if new_manifest == self.build_manifest:
+            return
+        # Keep the current build running until the new one has been
+        # downloaded, installed and verified by syncbuilds
+        if build_info is None:
+            self.shutdown_servers_and_exit("Build is no longer in the index")
+        elif installed:
+            if ROLLING_UPGRADES:
+                self.start_upgrade(build_info, new_manifest)
+            else:
+                logger.info("Index file has changed and build '%s' is installed. Reloading", build_info["build"])
+                self.shutdown_servers_and_exit("New build is available")
+        elif self._pending_manifest != new_manifest:
+            self._pending_manifest = new_manifest
+            txt = "Build '%s' for ref '%s' is not installed yet. Running build '%s' until it is" % (build_info["build"], self.ref, self.build_info["build"])
+            logger.info(txt)
+            log_event("build_pending", txt, ref=self.ref, tenant_name=self.tenant)
+
+    @reactor_callback
+    def on_server_output(self, pid, line):
+        server = self.battleserver_instances.get(pid)
+        if server is None:
+            return
+        logger.debug("stdout: %s", line)
+        if "Game Engine Initialized." in line and server.state == "starting":
+            logger.info("Game server has started up!")
+            server.set_state("started")
+            server.ready_time = time.time()
+            self.breaker.record_success()
+            server.timers.pop("start").cancel()
+            server.set_timer("poll", self.reactor.call_later(SERVER_CHECK_INTERVAL, self.poll_server, pid))
+            # Frees up a slot for the next server in the ramp-up
+            self.schedule_reconcile()
+
+    @reactor_callback
+    def on_server_exit(self, pid, returncode):
+        self.run_in_background(unregister_process, (pid,))
+        server = self.battleserver_instances.pop(pid, None)
+        if server is None:
+            # We killed this one ourselves
+            return
+        server.cancel_timers()
+        state = server.state
+        server.set_state("exited")
+        self.run_in_background(release_port, (server.port,))
+        logger.info("Process %s running server '%s' has exited with code %s", pid, server.resource, returncode)
+        self.run_in_background(_report_exit, (server.resource,), self.on_exit_reported, (returncode, state, server.start_time))
+
+    @reactor_callback
+    def on_exit_reported(self, returncode, state, start_time, resource_status):
+        """
+        Count the exit of a server that was in 'state' as a failure if it
+        crashed, or exited before it had been up for START_TIMEOUT. A clean
+        exit after a short match no poll saw is not a failure.
+        """
+        if resource_status == "running":
+            self.breaker.record_failure("Exited with code %s during a match" % returncode)
+        elif state == "starting" or resource_status == "starting":
+            self.breaker.record_failure("Exited with code %s before starting up" % returncode)
+        elif state == "started" and time.time() - start_time < START_TIMEOUT:
+            self.breaker.record_failure("Exited with code %s right after starting up" % returncode)
+        elif returncode not in (0, None):
+            self.breaker.record_failure("Exited with code %s" % returncode)
+        # else the instance has updated the status
+        logger.info("Restarting UE4 Server...")
+        self.schedule_reconcile(RESPAWN_DELAY)
+
+    @reactor_callback
+    def on_start_timeout(self, pid):
+        server = self.battleserver_instances.get(pid)
+        if server is None or server.state != "starting":
+            return
+        logger.error("Server still hasn't started after %.0f seconds!" % (time.time() - server.start_time))
+        self.kill_server(pid, "killed", "Failed to start")
+        self.breaker.record_failure("Not started after %.0f seconds" % START_TIMEOUT)
+        self.schedule_reconcile()
+
+    @reactor_callback
+    def poll_server(self, pid):
+        """
+        Poll the REST resource of a started server for pending commands and
+        its status in the background.
+        """
+        server = self.battleserver_instances.get(pid)
+        if server is None:
+            return
+        self.run_in_background(_poll_resource, (server.resource,), self.on_server_polled, (pid,))
+
+    @reactor_callback
+    def on_server_polled(self, pid, resp):
+        """
+        Act on the commands and status of a server, and check that it is
+        still heartbeating.
+        """
+        server = self.battleserver_instances.get(pid)
+        if server is None:
+            return
+        server.set_timer("poll", self.reactor.call_later(SERVER_CHECK_INTERVAL, self.poll_server, pid))
+        if resp is None:
+            # Logged by run_in_background. Tried again on the next poll.
+            return
+        if any(cmd["command"] == "kill" for cmd in resp["pending_commands"]):
+            logger.error("External command to kill servers!")
+            self.shutdown_servers_and_exit("Received command to kill all")
+            return
+
+        resource_status = resp["status"]
+        self.update_resource_status(server, resource_status)
+        if server.state == "exited":
+            return
+        diff = time.time() - server.start_time
+        if diff > START_TIMEOUT and resource_status == "starting":
+            logger.error("Server is still in status '%s' after %.0f seconds!" % (resource_status, diff))
+            self.kill_server(pid, "killed", "Failed to reach 'started' status")
+            self.breaker.record_failure("Still in status '%s' after %.0f seconds" % (resource_status, diff))
+            logger.info("Restarting UE4 Server...")
+            self.schedule_reconcile()
+        else:
+            heartbeat_date = dateutil.parser.parse(resp["heartbeat_date"]).replace(tzinfo=None)
+            heartbeat_diff = (datetime.datetime.utcnow()-heartbeat_date).total_seconds()
+            if heartbeat_diff > HEARTBEAT_TIMEOUT:
+                logger.error("Server heartbeat is %s seconds old. The process must be frozen", heartbeat_diff)
+                self.kill_server(pid, "killed", "Heartbeat timeout")
+                self.breaker.record_failure("Heartbeat is %.0f seconds old" % heartbeat_diff)
+                logger.info("Restarting UE4 Server...")
+                self.schedule_reconcile()
+
+    def load_build(self):
+        """
+        Pick the build to run. Returns False if neither the build for the ref
+        nor the one its registered servers were started from is installed.
+        Must be called before start(). Reads the index, the process registry
+        and the build usage table, so the supervisor runs it in the
+        background.
+        """
+        build_info = get_manifest(self.ref)
+        build_manifest = find_build_manifest(self.ref)
+
+        if not _is_executable_installed(build_info):
+            running_info = _registered_build(self.ref, self.tenant)
+            if running_info is None:
+                log_event("build_not_installed", "Build '%s' not installed. Cannot start daemon." % build_info["build"], ref=self.ref, tenant_name=self.tenant)
+                return False
+            # Keep the servers of the previous daemon and run their build
+            # until check_config() finds the new one installed
+            txt = "Build '%s' for ref '%s' is not installed yet. Running build '%s' until it is" % (build_info["build"], self.ref, running_info["build"])
+            logger.info(txt)
+            log_event("build_pending", txt, ref=self.ref, tenant_name=self.tenant)
+            self._pending_manifest = build_manifest
+            build_info = running_info
+            build_manifest = None
+        touch_build(build_info["build"])
+
+        self.build_info = build_info
+        self.build_manifest = build_manifest
+        return True
+
+    def start(self, reactor, on_exit=None):
+        """
+        Start supervising battleservers of the build picked by load_build()
+        on 'reactor'. If 'on_exit' is given it is called with the daemon when
+        it shuts down, otherwise the process exits.
+        """
+        self.reactor = reactor
+        self.on_exit = on_exit
+        self._spawn_pool = ThreadPool(SPAWN_CONCURRENCY)
+        self._background_pool = ThreadPool(BACKGROUND_CONCURRENCY)
+        self._adopting = True
+        self.run_in_background(self.load_adoptees, (), self.adopt_servers)
+
+        # Everything from here on is driven by events: server output and
+        # exit notifications from the reader threads, the timers below and
+        # the timers of each server.
+        self.reactor.call_soon(self.check_config)
+        self.reactor.call_later(WARM_POOL_METRICS_INTERVAL, self.report_pool_metrics)
+        self.schedule_reconcile()
+
+    def load_adoptees(self):
+        """
+        Find the servers for this ref that are still running from before the
+        daemon was restarted, and kill the ones that can't be taken over.
+        Returns a list of (process, registry entry, server resource, started,
+        log offset) for the others. Runs on a background thread.
+        """
+        adoptees = []
+        to_kill = []
+        registered = find_processes(self.ref, self.tenant)
+        for p, entry in registered:
+            try:
+                adoptees.append(self.load_adoptee(p, entry))
+            except Exception as e:
+                logger.warning("Could not take over server with pid %s: %s. Killing it", p.pid, e)
+                to_kill.append(p)
+        scanned = is_ref_scanned(self.ref, self.tenant)
+        if not scanned:
+            # Servers started before there was a registry can't be taken over
+            to_kill += _scan_unregistered(self.ref, self.tenant, [p for p, entry in registered])
+        terminate_processes(to_kill)
+        if not scanned:
+            mark_ref_scanned(self.ref, self.tenant)
+        if to_kill:
+            txt = "Killed %s servers for ref '%s' that could not be taken over" % (len(to_kill), self.ref)
+            log_event("servers_not_adopted", txt, details={"killed": [p.pid for p in to_kill]}, ref=self.ref, tenant_name=self.tenant)
+        return adoptees
+
+    def load_adoptee(self, p, entry):
+        """
+        Reattach to the resource of the registered server process 'p' and
+        read from its log file whether it had started up.
+        """
+        if not entry.get("url") or not entry.get("log_file"):
+            raise RuntimeError("Registered without its server resource and log file")
+        resource = ServerResource(get_battle_api(self.tenant), self.tenant, None, url=entry["url"])
+        started = False
+        offset = 0
+        if os.path.exists(entry["log_file"]):
+            with open(entry["log_file"], "rb") as f:
+                for line in iter(f.readline, b""):
+                    if "Game Engine Initialized." in line:
+                        started = True
+                offset = f.tell()
+        return p, entry, resource, started, offset
+
+    @reactor_callback
+    def adopt_servers(self, adoptees):
+        """
+        Take over the servers for this ref that are still running from before
+        the daemon was restarted, so a restart doesn't end their matches.
+        Their log is followed from where load_adoptees() left off in place of
+        their stdout.
+        """
+        self._adopting = False
+        adopted = []
+        for p, entry, resource, started, offset in adoptees or []:
+            server = BattleServer(p, resource, entry["port"], entry["build"])
+            server.start_time = entry["create_time"]
+            self.battleserver_instances[server.pid] = server
+            self.reactor.watch_log(p, entry["log_file"], offset, self.on_server_output, self.on_server_exit)
+            if started:
+                server.set_state("started")
+                server.ready_time = time.time()
+                # The first poll finds out whether it is in a match
+                server.set_timer("poll", self.reactor.call_soon(self.poll_server, server.pid))
+            else:
+                remaining = START_TIMEOUT - (time.time() - server.start_time)
+                server.set_timer("start", self.reactor.call_later(max(0, remaining), self.on_start_timeout, server.pid))
+            logger.info("Took over %s", server)
+            adopted.append(server)
+        if adopted:
+            txt = "Took over %s servers for ref '%s'" % (len(adopted), self.ref)
+            logger.info(txt)
+            log_event("servers_adopted", txt, details={"adopted": [str(s) for s in adopted]}, ref=self.ref, tenant_name=self.tenant)
+        self.schedule_reconcile()
 
-            command_line = config_file["command-line"]
-            status = "starting"
+    def run(self):
 
-            build_path = build_info["build"]
-            executable = os.path.join(config.BSD_BATTLESERVER_FOLDER, build_info["build"], build_info["executable_path"])
-            if not os.path.exists(executable):
-                log_event("build_not_installed", "Build '%s' not installed. Cannot start daemon." % build_info["build"])
+        try:
+            if not self.load_build():
                 return
-
-            start_time = time.time()
-            loop_cnt = 0
-            # read line without blocking
-            while 1:
-                loop_cnt += 1
-                diff = (time.time() - start_time)
-                p = None
-                config_num_processes = get_num_processes(self.ref, self.tenant)
-                if config_num_processes != self.num_processes:
-                    txt = "Number of processes in config for ref '%s' has changed from %s to %s" % (self.ref, self.num_processes, config_num_processes)
-                    logger.warning(txt)
-                    log_event("num_processes_changed", txt)
-                    # if we should run more processes: no problem, we'll add them in automatically
-                    # but if we should run fewer processes we need to kill some
-                    self.num_processes = config_num_processes
-
-                    if len(self.battleserver_instances) > self.num_processes:
-                        servers_killed = []
-                        while len(self.battleserver_instances) > self.num_processes:
-                            logger.info("I am running %s battleservers but should be running %s. Killing servers..." % (len(self.battleserver_instances), self.num_processes))
-                            # try to find a server that is not 'running'. If no such servers are found then kill a running one
-                            for pid, (q, battleserver_resource, status) in self.battleserver_instances.items():
-                                resource_status = battleserver_resource.get_status()
-                                if resource_status != "running":
-                                    logger.info("Found battleserver in state '%s' to kill: %s" % (resource_status, battleserver_resource))
-                                    pid_to_kill = pid
-                                    break
-                            else:
-                                logger.warning("Found no battleserver to kill that was not 'running'. I will kill a running one")
-                                pid_to_kill = self.battleserver_instances.keys()[0]
-
-                            try:
-                                p = psutil.Process(pid_to_kill)
-                                q, battleserver_resource, status = self.battleserver_instances[pid_to_kill]
-                                logger.info("Killing server with pid %s" % pid_to_kill)
-                                p.terminate()
-                                servers_killed.append(str(pid_to_kill))
-                                battleserver_resource.set_status("killed", {"status-reason": "Scaling down"})
-                            except psutil.NoSuchProcess:
-                                logger.info("Cannot kill %s because it's already dead")
-
-                            del self.battleserver_instances[pid_to_kill]
-                            time.sleep(5.0)
-                        txt = "Done killing servers for ref '%s'. Killed servers %s and am now running %s servers" % (self.ref, ", ".join(servers_killed), len(self.battleserver_instances))
-                        log_event("servers_killed", txt)
-
-                if self.num_processes == 0:
-                    logger.info("Running zero processes")
-                    time.sleep(10)
-                    continue
-
-                if len(self.battleserver_instances) < self.num_processes:
-                    num_added = 0
-                    while len(self.battleserver_instances) < self.num_processes:
-                        logger.info("I am running %s battleservers but should be running %s. Adding servers..." % (len(self.battleserver_instances), self.num_processes))
-                        pid, q, battleserver_resource = self.start_battleserver()
-                        self.battleserver_instances[pid] = (q, battleserver_resource, "starting")
-                        num_added += 1
-                        time.sleep(5.0)
-                    logger.info("Done adding servers. Running instances: %s" % ",".join([str(p) for p in self.battleserver_instances.keys()]))
-
-                    txt = "Done adding servers for ref '%s'. Added %s servers and am now running %s servers" % (self.ref, num_added, len(self.battleserver_instances))
-                    log_event("servers_added", txt)
-
-                for pid, (q, battleserver_resource, status) in self.battleserver_instances.iteritems():
-                    try:
-                        p = psutil.Process(pid)
-                    except psutil.NoSuchProcess:
-                        logger.info("Process %s running server '%s' has died", pid, battleserver_resource)
-                        resource_status = battleserver_resource.get_status()
-                        if resource_status == "starting":
-                            battleserver_resource.set_status("abnormalexit", {"status-reason": "Failed to start"})
-                        if resource_status == "running":
-                            battleserver_resource.set_status("abnormalexit", {"status-reason": "Died prematurely"})
-                        # else the instance has updated the status
-                        time.sleep(5.0)
-                        logger.info("Restarting UE4 Server (1)...")
-                        del self.battleserver_instances[pid]
-                        break
-
-                new_index_file = get_index()
-                old_manifest = find_build_manifest(index_file, self.ref)
-                new_manifest = find_build_manifest(new_index_file, self.ref)
-
-                if old_manifest != new_manifest:
-                    build_info = get_manifest(self.ref)
-                    build_path = build_info["build"]
-
-                    logger.info("Index file has changed. Reloading")
-                    self.shutdown_servers_and_exit("New build is available")
-                while 1:
-                    if not self.battleserver_instances:
-                        break
-                    empty = True
-                    for pid, (q, battleserver_resource, status) in self.battleserver_instances.iteritems():
-                        try:
-                            line = q.get(timeout=.1)
-                        except Empty:
-                            #sys.stdout.write(".")
-                            print "%s..." % pid
-                            time.sleep(1.0)
-                        else: # got line
-                            empty = False
-                            logger.debug("stdout: %s", line)
-                            if "Game Engine Initialized." in line:
-                                logger.info("Game server has started up!")
-                                status = "started"
-                                self.battleserver_instances[pid] = (q, battleserver_resource, status)
-                            if line == "ProcessExit":
-                                logger.info("UE4 Process has exited")
-                                resource_status = battleserver_resource.get_status()
-                                if resource_status == "starting":
-                                    battleserver_resource.set_status("abnormalexit", {"status-reason": "Failed to start"})
-                                # else the instance has updated the status
-                                time.sleep(5.0)
-                                logger.info("Restarting UE4 Server (2)...")
-                                try:
-                                    p = psutil.Process(pid)
-                                    if p: p.terminate()
-                                except:
-                                    pass
-                                del self.battleserver_instances[pid]
-                                empty = True
-                                break
-                    if empty:
-                        time.sleep(1.0)
-                        break
-                for pid, (q, battleserver_resource, status) in self.battleserver_instances.items():
-                    if status == "starting" and diff > 60.0:
-                        logger.error("Server still hasn't started after %.0f seconds!" % diff)
-                        sys.exit(-1)
-                    elif status == "started" and loop_cnt % 10 == 0:
-                        resp = battleserver_resource.get().json()
-                        if len(resp["pending_commands"]) > 0:
-                            for cmd in resp["pending_commands"]:
-                                logger.warning("I should execute the following command: '%s'", cmd["command"])
-                                command_resource = copy.copy(battleserver_resource)
-                                command_resource.location = cmd["url"]
-                                command_resource.patch(data={"status": "running"})
-
-                                if cmd["command"] == "kill":
-                                    logger.error("External command to kill servers!")
-                                    self.shutdown_servers_and_exit("Received command to kill all")
-
-                        resource_status = resp["status"]
-                        if diff > 60.0 and resource_status == "starting":
-                            logger.error("Server is still in status '%s' after %.0f seconds!" % (resource_status, diff))
-                            battleserver_resource.set_status("killed", {"status-reason": "Failed to reach 'started' status"})
-                            time.sleep(5.0)
-                            logger.info("Restarting UE4 Server (4)...")
-                            try:
-                                p = psutil.Process(pid)
-                                if p: p.terminate()
-                            except:
-                                pass
-                            del self.battleserver_instances[pid]
-                        else:
-                            heartbeat_date = dateutil.parser.parse(resp["heartbeat_date"]).replace(tzinfo=None)
-                            heartbeat_diff = (datetime.datetime.utcnow()-heartbeat_date).total_seconds()
-                            if heartbeat_diff > 60:
-                                logger.error("Server heartbeat is %s seconds old. The process must be frozen", heartbeat_diff)
-                                battleserver_resource.set_status("killed", {"status-reason": "Heartbeat timeout"})
-                                time.sleep(5.0)
-                                logger.info("Restarting UE4 Server (5)...")
-                                try:
-                                    p = psutil.Process(pid)
-                                    if p: p.terminate()
-                                except:
-                                    pass
-                                del self.battleserver_instances[pid]
+            reactor = Reactor()
+            self.start(reactor)
+            reactor.run()
 
         except KeyboardInterrupt:
             logger.info("User exiting...")
@@ -435,6 +1158,20 @@ class Daemon(object):
             logger.exception("Fatal error occurred in run_battleserver_loop. Exiting")
             self.shutdown_servers_and_exit("Fatal error, '%s' occurred in run_battleserver_loop" % e)
 
+_machine_resources = {}
+_machine_resources_lock = Lock()
+
+def _get_machine_resource(sess, battle_api_host, tenant):
+    """
+    The machine resource is looked up once per tenant and shared by all
+    servers spawned from this process.
+    """
+    with _machine_resources_lock:
+        key = (battle_api_host, tenant)
+        if key not in _machine_resources:
+            _machine_resources[key] = get_machine_resource(sess, battle_api_host, tenant)
+        return _machine_resources[key]
+
 def get_battleserver_command(image_name, executable_path, command_line, tenant, **kw):
     command_line = command_line or []
     tenant = tenant or "default"
@@ -451,7 +1188,7 @@ def get_battleserver_command(image_name, executable_path, command_line, tenant,
     # Register machine and server info
     sess = get_battle_api(tenant)
     battle_api_host = get_root_endpoint(tenant)
-    machine_resource = get_machine_resource(sess, battle_api_host, tenant)
+    machine_resource = _get_machine_resource(sess, battle_api_host, tenant)
     logger.info("Machine resource: %s", machine_resource)
     public_ip = machine_resource.data.get("public_ip")
 
@@ -462,7 +1199,7 @@ def get_battleserver_command(image_name, executable_path, command_line, tenant,
 
     jti_token = get_auth_token(tenant, "battleserver")["jti"]
     # See UE4 command line arguments at http://tinyurl.com/oygdwy3
-    port = _get_available_port(MIN_PORT, MAX_PORT)
+    port = lease_port(MIN_PORT, MAX_PORT)
 
 #Battle_Lava+End+Lobby+Login+Main -server -log -Messaging -nomcp -pak -CrashForUAT -SessionId=B0166D674598A24A73B8D29174F9826E -SessionOwner="matth" -SessionName="deditcatedad server"
     battleserver_info = {
@@ -478,11 +1215,16 @@ def get_battleserver_command(image_name, executable_path, command_line, tenant,
     battleserver_info["port"] = port
 
     #battleserver_resource = RESTResource(sess, battle_api_host"/servers", battleserver_info)
-    battleserver_resource = ServerResource(sess, tenant, battleserver_info)
+    try:
+        battleserver_resource = ServerResource(sess, tenant, battleserver_info)
+    except Exception:
+        release_port(port)
+        raise
     logger.debug("Battleserver resource: %s", battleserver_resource)
 
     server_id = battleserver_resource.data["server_id"]
     token = battleserver_resource.data["token"]
+    log_file = "{}/{}/server_{}.log".format(_get_logfolder(), tenant, server_id)
     command += [
         "-drift_url={}".format(battle_api_host),
         "-server_url={}".format(battleserver_resource.location),
@@ -498,12 +1240,12 @@ def get_battleserver_command(image_name, executable_path, command_line, tenant,
         "-jti={}".format(jti_token),  # Access token for REST API calls.
         #"-log",
         #"-Messaging"
-        "-abslog={}/{}/server_{}.log".format(_get_logfolder(), tenant, server_id),
+        "-abslog={}".format(log_file),
         "-CrashForUAT",
     ]
     battleserver_resource.put({"status": "pending", "command_line": " ".join(command)})
 
-    return command, battleserver_resource
+    return command, battleserver_resource, port, log_file
 
 def list_tempfolder():
     """
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+    Drift game server management - UDP Port Leases
+    ------------------------------------------------
+    Battleservers only bind their UDP port once they have loaded, so a free
+    port can't be detected reliably by trying to bind it. Instead ports are
+    leased from a table that is shared by all daemon processes on the
+    machine. The table is a JSON file guarded by an exclusive file lock.
+
+    A lease is first held by the process that asked for it and is then
+    assigned to the battleserver process once it has been spawned. Leases
+    whose owner has died are reclaimed.
+"""
+import os
+import json
+import socket
+import time
+from contextlib import contextmanager
+
+import psutil
+
+import config
+from logsetup import logger
+from serverdaemon.utils import file_lock, replace_file
+
+LEASE_FILENAME = os.path.join(config.BSD_STATE_FOLDER, "port_leases.json")
+LOCK_FILENAME = LEASE_FILENAME + ".lock"
+
+# Seconds a lease may stay unassigned before it is considered stale. Covers
+# spawns that failed without releasing their port.
+PENDING_LEASE_TIMEOUT = 120.0
+
+
+@contextmanager
+def _lease_table():
+    """
+    Lock the lease table and yield it for reading and modification. The
+    table is written back when the block exits without an error.
+    """
+    with file_lock(LOCK_FILENAME):
+        table = {"next": None, "leases": {}}
+        try:
+            with open(LEASE_FILENAME, "r") as f:
+                table = json.load(f)
+        except IOError:
+            pass
+        except ValueError as e:
+            logger.warning("Port lease file '%s' is corrupt. Starting over: %s", LEASE_FILENAME, e)
+        yield table
+        # Written aside and swapped in so a daemon killed halfway through
+        # doesn't leave a truncated table behind
+        with open(LEASE_FILENAME + ".tmp", "w") as f:
+            json.dump(table, f)
+        replace_file(LEASE_FILENAME + ".tmp", LEASE_FILENAME)
+
+
+def _is_stale(lease, now):
+    try:
+        p = psutil.Process(lease["pid"])
+        if abs(p.create_time() - lease["create_time"]) > 1.0:
+            # The pid has been reused by another process
+            return True
+    except psutil.NoSuchProcess:
+        return True
+    if lease.get("pending") and now - lease["leased_at"] > PENDING_LEASE_TIMEOUT:
+        return True
+    return False
+
+
+def _can_bind(port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.bind(('', port))
+        return True
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+
+
+def lease_port(min_port, max_port):
+    """
+    Lease a free UDP port in the range 'min_port' to 'max_port' (inclusive)
+    for the calling process. The lease should be handed over to the process
+    that binds the port with assign_port(), or given back with release_port().
+    """
+    p = psutil.Process(os.getpid())
+    num_ports = max_port - min_port + 1
+    with _lease_table() as table:
+        leases = table["leases"]
+        now = time.time()
+        start = table.get("next") or min_port
+        if not min_port <= start <= max_port:
+            start = min_port
+        # Allocation starts where the last one left off so a free port is
+        # usually found on the first try.
+        for i in xrange(num_ports):
+            port = min_port + (start - min_port + i) % num_ports
+            lease = leases.get(str(port))
+            if lease:
+                if not _is_stale(lease, now):
+                    continue
+                logger.info("Reclaiming stale lease on port %s held by pid %s", port, lease["pid"])
+            if not _can_bind(port):
+                # In use by something that doesn't go through the lease table
+                continue
+            leases[str(port)] = {
+                "pid": p.pid,
+                "create_time": p.create_time(),
+                "leased_at": now,
+                "pending": True,
+            }
+            table["next"] = min_port + (port - min_port + 1) % num_ports
+            logger.debug("Leased port %s", port)
+            return port
+
+    raise RuntimeError(
+        "Exhausted trying to find available UPD port number in the range "
+        "of %s to %s." % (min_port, max_port)
+        )
+
+
+def assign_port(port, pid):
+    """
+    Hand the lease on 'port' over to the process 'pid'. The lease is released
+    automatically once that process is gone.
+    """
+    create_time = psutil.Process(pid).create_time()
+    with _lease_table() as table:
+        table["leases"][str(port)] = {
+            "pid": pid,
+            "create_time": create_time,
+            "leased_at": time.time(),
+        }
+
+
+def release_port(port):
+    with _lease_table() as table:
+        table["leases"].pop(str(port), None)
+    logger.debug("Released port %s", port)
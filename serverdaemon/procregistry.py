@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+    Drift game server management - Process Registry
+    ------------------------------------------------
+    Keeps track of the battleserver processes spawned on the machine so they
+    can be found again without scanning every process on the box. A daemon
+    that is restarted uses it to take over the servers of the one before it,
+    and to clean up the ones it can't take over. The registry is a JSON file
+    shared by all daemon processes, guarded by an exclusive file lock like
+    the port leases.
+
+    Entries are keyed by pid and hold the process create time, so an entry
+    whose pid has been reused by another process is never mistaken for a
+    battleserver.
+
+    Servers started before there was a registry aren't in it. Each ref and
+    tenant is marked once the daemon has scanned the machine for those, so
+    the scan is done once per ref rather than once per machine.
+"""
+import os
+import json
+from contextlib import contextmanager
+
+import psutil
+
+import config
+from logsetup import logger
+from serverdaemon.utils import file_lock, replace_file
+
+REGISTRY_FILENAME = os.path.join(config.BSD_STATE_FOLDER, "processes.json")
+SCANNED_FILENAME = os.path.join(config.BSD_STATE_FOLDER, "scanned_refs.json")
+LOCK_FILENAME = REGISTRY_FILENAME + ".lock"
+
+# Seconds processes get to exit after being terminated, and then after being
+# killed
+TERMINATE_TIMEOUT = 10.0
+KILL_TIMEOUT = 5.0
+
+
+@contextmanager
+def _table(filename):
+    with file_lock(LOCK_FILENAME):
+        table = {}
+        try:
+            with open(filename, "r") as f:
+                table = json.load(f)
+        except IOError:
+            pass
+        except ValueError as e:
+            logger.warning("Process registry '%s' is corrupt. Starting over: %s", filename, e)
+        yield table
+        with open(filename + ".tmp", "w") as f:
+            json.dump(table, f)
+        replace_file(filename + ".tmp", filename)
+
+
+def _registry():
+    return _table(REGISTRY_FILENAME)
+
+
+def _scan_key(ref, tenant):
+    return "%s/%s" % (tenant, ref)
+
+
+def is_ref_scanned(ref, tenant):
+    """
+    Return True if the machine has been scanned for unregistered servers of
+    'ref' and 'tenant'.
+    """
+    with _table(SCANNED_FILENAME) as table:
+        return _scan_key(ref, tenant) in table
+
+
+def mark_ref_scanned(ref, tenant):
+    with _table(SCANNED_FILENAME) as table:
+        table[_scan_key(ref, tenant)] = True
+
+
+def register_process(pid, ref, tenant, build_info, port, url, log_file):
+    """
+    Record the battleserver 'pid' running the build in 'build_info' for 'ref'
+    and 'tenant' on 'port'. 'url' is the location of its server resource and
+    'log_file' the log it writes.
+    """
+    with _registry() as table:
+        table[str(pid)] = {
+            "pid": pid,
+            "create_time": psutil.Process(pid).create_time(),
+            "ref": ref,
+            "tenant": tenant,
+            "build": build_info["build"],
+            "build_info": build_info,
+            "port": port,
+            "url": url,
+            "log_file": log_file,
+        }
+
+
+def unregister_process(pid):
+    with _registry() as table:
+        table.pop(str(pid), None)
+
+
+def _get_process(entry):
+    try:
+        p = psutil.Process(entry["pid"])
+        if abs(p.create_time() - entry["create_time"]) <= 1.0:
+            return p
+    except psutil.NoSuchProcess:
+        pass
+    return None
+
+
+def find_processes(ref, tenant):
+    """
+    Return (psutil.Process, entry) for the live processes registered for
+    'ref' and 'tenant'. Entries of processes that are gone are dropped.
+    """
+    result = []
+    with _registry() as table:
+        for key, entry in table.items():
+            p = _get_process(entry)
+            if p is None:
+                del table[key]
+            elif entry["ref"] == ref and entry["tenant"] == tenant:
+                result.append((p, entry))
+    return result
+
+
+def terminate_processes(processes, timeout=TERMINATE_TIMEOUT):
+    """
+    Terminate all of 'processes' at once and wait up to 'timeout' seconds
+    for them to exit, then kill the ones that are left. Returns the
+    processes that survived being killed.
+    """
+    for p in processes:
+        try:
+            p.terminate()
+        except psutil.NoSuchProcess:
+            pass
+    gone, alive = psutil.wait_procs(processes, timeout=timeout)
+    if alive:
+        logger.warning("%s processes did not exit within %s seconds of being terminated. Killing them", len(alive), timeout)
+        for p in alive:
+            try:
+                p.kill()
+            except psutil.NoSuchProcess:
+                pass
+        gone, alive = psutil.wait_procs(alive, timeout=KILL_TIMEOUT)
+        for p in alive:
+            logger.error("Process %s is still running after being killed", p.pid)
+    return alive
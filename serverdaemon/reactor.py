@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""
+    Drift game server management - Event Loop
+    ------------------------------------------------
+    A small reactor that multiplexes battleserver output, process exit
+    notifications and timers onto a single thread.
+
+    Windows pipes cannot be waited on with select(), so each child process
+    gets a helper thread that reads its stdout and posts events into one
+    shared queue. Processes started by an earlier daemon have no pipe to
+    read, so their thread follows their log file instead. The reactor thread
+    blocks on that queue until either an event arrives or the next timer is
+    due.
+
+    Timers live on a hierarchical timer wheel so that scheduling and
+    cancelling are O(1) no matter how many servers have timers pending.
+"""
+import io
+import os
+import collections
+import math
+import time
+from threading import Thread
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty  # python 3.x
+
+from logsetup import logger
+
+# Upper bound on how long the reactor blocks in one go. Keeps the loop
+# responsive to KeyboardInterrupt which cannot interrupt a lock wait on Windows.
+MAX_WAIT = 1.0
+# Resolution of the timer wheel in seconds. Timers never fire early but may
+# fire up to one tick late.
+TICK = 0.01
+# Each level of the wheel has 2**WHEEL_BITS slots and covers 2**WHEEL_BITS
+# times the span of the level below. Four levels cover about 46 hours, timers
+# further out wait in an overflow list.
+WHEEL_BITS = 6
+WHEEL_SIZE = 1 << WHEEL_BITS
+WHEEL_MASK = WHEEL_SIZE - 1
+WHEEL_LEVELS = 4
+# Seconds between checks for new lines in a followed log file
+TAIL_INTERVAL = 0.5
+
+
+class Timer(object):
+    """
+    Handle for a callback scheduled with Reactor.call_later().
+    """
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerWheel(object):
+    """
+    Hierarchical timer wheel. A timer due within WHEEL_SIZE ticks goes into
+    the slot of its tick on the lowest level, later ones into coarser slots
+    on the levels above. Each time the lowest level wraps around, the next
+    slot of the level above is emptied into the levels below, so every timer
+    is moved at most WHEEL_LEVELS times. Cancelled timers are dropped when
+    their slot comes up.
+    """
+    def __init__(self, now):
+        self.tick = int(now / TICK)
+        self.levels = [[[] for i in xrange(WHEEL_SIZE)] for j in xrange(WHEEL_LEVELS)]
+        self.overflow = []
+        # Timers that are already due, in the order they were added
+        self.ready = collections.deque()
+
+    def add(self, timer):
+        tick = int(math.ceil(timer.when / TICK))
+        delta = tick - self.tick
+        if delta <= 0:
+            self.ready.append(timer)
+            return
+        for level in xrange(WHEEL_LEVELS):
+            if delta < 1 << (WHEEL_BITS * (level + 1)):
+                self.levels[level][(tick >> (WHEEL_BITS * level)) & WHEEL_MASK].append(timer)
+                return
+        self.overflow.append(timer)
+
+    def _cascade(self):
+        for level in xrange(1, WHEEL_LEVELS):
+            index = (self.tick >> (WHEEL_BITS * level)) & WHEEL_MASK
+            slot = self.levels[level][index]
+            self.levels[level][index] = []
+            for timer in slot:
+                if not timer.cancelled:
+                    self.add(timer)
+            if index:
+                return
+        overflow, self.overflow = self.overflow, []
+        for timer in overflow:
+            if not timer.cancelled:
+                self.add(timer)
+
+    def advance(self, now):
+        """
+        Move the wheel up to 'now', collecting the timers that became due
+        in 'ready'.
+        """
+        target = int(now / TICK)
+        while self.tick < target:
+            self.tick += 1
+            if not self.tick & WHEEL_MASK:
+                self._cascade()
+            index = self.tick & WHEEL_MASK
+            slot = self.levels[0][index]
+            if slot:
+                self.levels[0][index] = []
+                self.ready.extend(slot)
+
+    def time_to_next(self, now, limit):
+        """
+        Seconds until the next timer on the lowest level is due, or 'limit'
+        if that is sooner.
+        """
+        if self.ready:
+            return 0
+        for i in xrange(1, WHEEL_SIZE):
+            if self.levels[0][(self.tick + i) & WHEEL_MASK]:
+                return max(0, min((self.tick + i) * TICK - now, limit))
+            if not (self.tick + i) & WHEEL_MASK:
+                # Timers on the levels above get cascaded at the wrap-around
+                break
+        return max(0, min((self.tick + i) * TICK - now, limit))
+
+
+class Reactor(object):
+    def __init__(self):
+        self._events = Queue()
+        self._timers = TimerWheel(time.time())
+        self._running = False
+
+    def call_later(self, delay, callback, *args):
+        """
+        Run 'callback(*args)' on the reactor thread after 'delay' seconds.
+        Must be called from the reactor thread.
+        """
+        timer = Timer(time.time() + delay, callback, args)
+        self._timers.add(timer)
+        return timer
+
+    def call_soon(self, callback, *args):
+        return self.call_later(0, callback, *args)
+
+    def call_soon_threadsafe(self, callback, *args):
+        """
+        Run 'callback(*args)' on the reactor thread. Safe to call from any thread.
+        """
+        self._events.put((callback, args))
+
+    def run_in_pool(self, pool, fn, args, callback=None, callback_args=()):
+        """
+        Run 'fn(*args)' on the thread pool 'pool' and pass its result to
+        'callback(*callback_args, result)' on the reactor thread. If 'fn'
+        fails the error is logged and the result is None.
+        """
+        def work():
+            try:
+                result = fn(*args)
+            except Exception:
+                logger.exception("Background call to %s failed", fn.__name__)
+                result = None
+            if callback:
+                self.call_soon_threadsafe(callback, *(tuple(callback_args) + (result,)))
+        pool.apply_async(work)
+
+    def watch_process(self, process, on_line, on_exit):
+        """
+        Dispatch every line 'process' writes to stdout to 'on_line(pid, line)'
+        and call 'on_exit(pid, returncode)' once the process has exited.
+        'process' must be a subprocess.Popen object with stdout=PIPE.
+        """
+        def reader():
+            pid = process.pid
+            for line in iter(process.stdout.readline, b''):
+                self.call_soon_threadsafe(on_line, pid, line)
+            process.stdout.close()
+            returncode = process.wait()
+            self.call_soon_threadsafe(on_exit, pid, returncode)
+
+        t = Thread(target=reader)
+        t.daemon = True  # thread dies with the program
+        t.start()
+        return t
+
+    def watch_log(self, process, log_filename, offset, on_line, on_exit):
+        """
+        Like watch_process() for a process that was not started by this one.
+        'process' is a psutil.Process. The lines written to 'log_filename'
+        after 'offset' are dispatched to 'on_line(pid, line)' as they appear,
+        and 'on_exit(pid, None)' is called once the process is gone.
+        """
+        def reader():
+            pid = process.pid
+            partial = b''
+            f = None
+            try:
+                while True:
+                    if f is None and os.path.exists(log_filename):
+                        f = io.open(log_filename, "rb")
+                        f.seek(offset)
+                    data = f.read() if f else b''
+                    if data:
+                        lines = (partial + data).split(b'\n')
+                        partial = lines.pop()
+                        for line in lines:
+                            self.call_soon_threadsafe(on_line, pid, line + b'\n')
+                    elif not process.is_running():
+                        break
+                    else:
+                        time.sleep(TAIL_INTERVAL)
+            finally:
+                if f:
+                    f.close()
+            self.call_soon_threadsafe(on_exit, pid, None)
+
+        t = Thread(target=reader)
+        t.daemon = True  # thread dies with the program
+        t.start()
+        return t
+
+    def stop(self):
+        self.call_soon_threadsafe(self._stop)
+
+    def _stop(self):
+        self._running = False
+
+    def _run_timers(self):
+        """
+        Run all timers that are due and return the number of seconds until
+        the next one.
+        """
+        self._timers.advance(time.time())
+        ready = self._timers.ready
+        # Timers added by the callbacks that are due right away run in this
+        # pass as well
+        while ready:
+            timer = ready.popleft()
+            if not timer.cancelled:
+                timer.callback(*timer.args)
+        return self._timers.time_to_next(time.time(), MAX_WAIT)
+
+    def run(self):
+        """
+        Process events and timers until stop() is called.
+        """
+        logger.debug("Reactor starting")
+        self._running = True
+        while self._running:
+            timeout = self._run_timers()
+            if not self._running:
+                break
+            try:
+                callback, args = self._events.get(timeout=timeout)
+            except Empty:
+                continue
+            callback(*args)
+            # Drain whatever else has arrived before looking at the timers again
+            while self._running:
+                try:
+                    callback, args = self._events.get_nowait()
+                except Empty:
+                    break
+                callback(*args)
+        logger.debug("Reactor stopped")
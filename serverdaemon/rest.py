@@ -5,6 +5,7 @@
 """
 import os, sys, json
 import requests
+from threading import Lock
 
 import config
 from logsetup import logger
@@ -44,11 +45,25 @@ def get_auth_token(tenant, role):
     return r.json()
 
 
+_sessions = {}
+_sessions_lock = Lock()
+
 def get_battle_api(tenant, token=None):
-    """Returns a requests session for the battle service REST API."""
+    """
+    Returns a requests session for the battle service REST API.
+    Sessions authenticated as the battledaemon are shared per tenant so all
+    daemons in the process reuse one connection pool and token.
+    """
+    if token:
+        return _make_session(token)
+    with _sessions_lock:
+        if tenant not in _sessions:
+            token = get_auth_token(tenant, "battledaemon")["jti"]
+            _sessions[tenant] = _make_session(token)
+        return _sessions[tenant]
+
+def _make_session(token):
     sess = requests.Session()
-    if not token:
-        token = get_auth_token(tenant, "battledaemon")["jti"]
     sess.headers.update({
         'Content-type': 'application/json',
         'Accept': 'application/json',
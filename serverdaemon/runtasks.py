@@ -14,8 +14,10 @@ import getpass
 
 from utils import get_local_refs
 from logsetup import logger, log_event
+from config import config_file
 
 TASK_FOLDER = "\\Drift"
+SUPERVISOR_TASK_NAME = "Supervisor"
 PYTHON_PATH = r"c:\python27\python.exe"
 ROOT_PATH = os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), "..\\"))
 
@@ -29,7 +31,7 @@ def get_run_tasks(scheduler):
     ret = [(t.Definition.Actions[0].Arguments.split("--ref=")[-1].split(" ")[0], t.Name.split("=")[-1].split(",")[-1]) for t in colTasks if t.Name.startswith('Run ref=')]
     return set(ret)
 
-def remove_ref_task(scheduler, ref):
+def remove_ref_task(scheduler, ref, kill_processes=True):
     logger.warning("Removing task for ref '%s'" % str(ref))
     try:
         rootFolder = scheduler.GetFolder(TASK_FOLDER)
@@ -42,9 +44,10 @@ def remove_ref_task(scheduler, ref):
         logger.info("  Deleting task '%s'" % str(task_id))
         rootFolder.DeleteTask(task_id, 0)
 
-        logger.info("  Killing running processes ")
-        from daemon import kill_processes_by_ref
-        kill_processes_by_ref(ref[0], ref[1])
+        if kill_processes:
+            logger.info("  Killing running processes ")
+            from daemon import kill_processes_by_ref
+            kill_processes_by_ref(ref[0], ref[1])
         logger.info("Done removing task for ref '%s'" % str(ref))
 
     except Exception as e:
@@ -52,11 +55,43 @@ def remove_ref_task(scheduler, ref):
 
 def add_ref_task(scheduler, ref):
     logger.warning("Adding task for ref '%s'" % str(ref))
+    action_id = get_run_task_name(ref)
+    action_arguments = os.path.join(ROOT_PATH, "run.py run --ref=%s --tenant=%s" % (ref[0], ref[1]))
+    register_run_task(scheduler, action_id, action_arguments)
+    logger.info("Task for ref '%s' is now running" % str(ref))
+
+def has_supervisor_task(scheduler):
+    objTaskFolder = scheduler.GetFolder(TASK_FOLDER)
+    colTasks = objTaskFolder.GetTasks(1)
+    return any(t.Name == SUPERVISOR_TASK_NAME for t in colTasks)
+
+def add_supervisor_task(scheduler):
+    logger.warning("Adding supervisor task")
+    action_arguments = os.path.join(ROOT_PATH, "run.py supervise")
+    register_run_task(scheduler, SUPERVISOR_TASK_NAME, action_arguments)
+    logger.info("Supervisor task is now running")
+
+def remove_supervisor_task(scheduler):
+    logger.warning("Removing supervisor task")
+    try:
+        rootFolder = scheduler.GetFolder(TASK_FOLDER)
+        task = rootFolder.GetTask(SUPERVISOR_TASK_NAME)
+        task.Stop(0)
+        task.Enabled = False
+        time.sleep(5.0)
+        rootFolder.DeleteTask(SUPERVISOR_TASK_NAME, 0)
+        logger.info("Supervisor task removed")
+    except Exception as e:
+        logger.error("Exception occurred removing supervisor task: %s" % e)
+
+def register_run_task(scheduler, action_id, action_arguments):
+    """
+    Register a task that runs 'run.py' with 'action_arguments' and start it.
+    The task is restarted every minute if it is not running.
+    """
     rootFolder = scheduler.GetFolder(TASK_FOLDER)
 
-    action_id = get_run_task_name(ref)
     action_path = PYTHON_PATH
-    action_arguments = os.path.join(ROOT_PATH, "run.py run --ref=%s --tenant=%s" % (ref[0], ref[1]))
     action_workdir = ROOT_PATH
     author = getpass.getuser()
     description = "Automatically created task from Drift Config"
@@ -94,13 +129,35 @@ def add_ref_task(scheduler, ref):
     # start the task immediately
     task = rootFolder.GetTask(task_id)
     runningTask = task.Run("")
-    logger.info("Task for ref '%s' is now running" % str(ref))
+
+def update_supervisor_task(scheduler, actual_refs):
+    """
+    Run all refs on this machine from a single supervisor task. Per-ref run
+    tasks left over from before are removed. The servers of refs the
+    supervisor runs are left running for it to take over.
+    """
+    wanted_refs = get_local_refs() if actual_refs else set()
+    for ref in actual_refs:
+        remove_ref_task(scheduler, ref, kill_processes=(ref not in wanted_refs))
+        log_event("remove_ref_task", "Removed task for ref '%s'" % ref[0], ref=ref[0], tenant_name=ref[1])
+    if has_supervisor_task(scheduler):
+        logger.info('Supervisor task is installed. Nothing to do.')
+        return
+    add_supervisor_task(scheduler)
+    log_event("add_supervisor_task", "Added supervisor task")
 
 def update_tasks():
     scheduler = win.Dispatch("Schedule.Service")
     scheduler.Connect()
 
     actual_refs = get_run_tasks(scheduler)
+    if config_file.get("supervisor", True):
+        update_supervisor_task(scheduler, actual_refs)
+        return
+    # The per-ref tasks take over the refs from the supervisor
+    if has_supervisor_task(scheduler):
+        remove_supervisor_task(scheduler)
+        log_event("remove_supervisor_task", "Removed supervisor task")
     wanted_refs = get_local_refs()
     print "Currently installed refs: %s" % ", ".join(["%s:%s" % (r[0], r[1]) for r in actual_refs])
     print "I want to run the following refs: %s" % ", ".join(["%s:%s" % (r[0], r[1]) for r in wanted_refs])
@@ -15,62 +15,235 @@ from functools import wraps
 import sys
 import random
 import datetime
+import hashlib
+import urlparse
+import threading
+from threading import Lock
+from multiprocessing.pool import ThreadPool
 
 import boto
 import boto.ec2
 from boto.s3 import connect_to_region
-from boto.s3.connection import OrdinaryCallingFormat
+from boto.s3.connection import S3Connection, OrdinaryCallingFormat
+from boto.s3.key import Key
+from boto.exception import S3ResponseError
 import requests
 import config
-from logsetup import logger
-import dateutil.parser as parser
+from config import config_file
+from logsetup import logger, log_event
+from serverdaemon.utils import replace_file
+from serverdaemon.catalog import BuildCatalog, parse_build_filename
+from serverdaemon.buildverify import check_build, VERIFY_SAMPLE_SIZE
 
 # This is the S3 bucket name for server builds:
 bucket_name = "ncl-teamcity"
 
+# Number of parallel S3 requests used when syncing manifests
+S3_CONCURRENCY = config_file.get("s3-concurrency", 8)
+# ETags of the files synced from S3, stored next to index.json
+ETAGS_FILENAME = "etags.json"
+# Build archives are downloaded as byte ranges of this size...
+DOWNLOAD_CHUNK_SIZE = config_file.get("download-chunk-mb", 16) * 1024 * 1024
+# ...with this many ranges in flight at once
+DOWNLOAD_CONCURRENCY = config_file.get("download-concurrency", 8)
+# Number of attempts at fetching a single range before giving up
+DOWNLOAD_RETRIES = 3
+# Size of the reads from S3 and writes to disk when fetching a range
+IO_BUFFER_SIZE = 1024 * 1024
+# Build files on S3 younger than this many days are never cleaned up
+CLEANUP_MAX_DAYS = 30
+# Keys listed and deleted per request by cleanup_s3. 1000 is the S3 maximum.
+CLEANUP_BATCH_SIZE = 1000
+
+# boto connections must not be shared between threads, so each thread keeps
+# its own. The connection pools its HTTP connections to S3.
+_connections = threading.local()
+
+# Parsed index and manifest files keyed on filename. Each entry remembers the
+# mtime and size of the file it was parsed from so changes are picked up.
+_json_cache = {}
+_json_cache_lock = Lock()
+# BuildCatalog of the last index parsed
+_catalog = None
+
+def _load_json(filename):
+    """
+    Return the parsed contents of 'filename'. The file is only read again if
+    its mtime or size has changed since the last call. The returned object is
+    shared between callers and must not be modified.
+    """
+    st = os.stat(filename)
+    stamp = (st.st_mtime, st.st_size)
+    with _json_cache_lock:
+        entry = _json_cache.get(filename)
+        if entry and entry[0] == stamp:
+            return entry[1]
+    logger.debug("Loading '%s'", filename)
+    with open(filename, "r") as f:
+        contents = json.load(f)
+    with _json_cache_lock:
+        _json_cache[filename] = (stamp, contents)
+    return contents
+
+def _write_if_changed(filename, contents):
+    """
+    Write 'contents' to 'filename' unless the file already holds exactly that.
+    Leaving the file alone keeps the cached copy in _json_cache valid. The
+    file is replaced atomically so readers never see a partial write.
+    """
+    try:
+        with open(filename, "rb") as f:
+            if f.read() == contents:
+                return False
+    except IOError:
+        pass
+    with open(filename + ".tmp", "wb") as f:
+        f.write(contents)
+    replace_file(filename + ".tmp", filename)
+    return True
+
+def _connect():
+    """
+    Connect to S3 in the build region, or to the S3 compatible service at
+    's3-endpoint' in config.json if set (e.g. a local stand-in for testing).
+    """
+    endpoint = config_file.get("s3-endpoint")
+    if endpoint:
+        url = urlparse.urlparse(endpoint)
+        return S3Connection(host=url.hostname, port=url.port, is_secure=(url.scheme == "https"),
+                            calling_format=OrdinaryCallingFormat())
+    return connect_to_region(config.S3_REGION_NAME, calling_format=OrdinaryCallingFormat())
+
+def get_bucket(bucket_name=None):
+    """
+    Return the S3 bucket 'bucket_name', by default the build bucket, on a
+    connection owned by the calling thread.
+    """
+    bucket_name = bucket_name or config.BUILD_BUCKET
+    conn = getattr(_connections, "conn", None)
+    if conn is None:
+        conn = _connections.conn = _connect()
+    return conn.get_bucket(bucket_name, validate=False)
+
+def _get_if_changed(bucket, path, etag=None):
+    """
+    Download 'path' unless its ETag on S3 is still 'etag'. Returns a tuple of
+    (contents, etag) where contents is None if the file has not changed, or
+    None if the file does not exist.
+    """
+    key = bucket.new_key(path)
+    headers = {"If-None-Match": etag} if etag else None
+    try:
+        contents = key.get_contents_as_string(headers=headers)
+    except S3ResponseError as e:
+        if e.status == 304:
+            return None, etag
+        if e.status == 404:
+            return None
+        raise
+    return contents, key.etag
+
+def get_catalog():
+    """
+    Return a BuildCatalog of the local index.json. It is rebuilt when the
+    index changes.
+    """
+    global _catalog
+    index_file = get_index()
+    with _json_cache_lock:
+        if _catalog is None or _catalog.index_file is not index_file:
+            _catalog = BuildCatalog(index_file)
+        return _catalog
+
 def sync_index():
+    """
+    Bring the local copies of index.json and the build manifests it refers to
+    up to date with S3. index.json is fetched with a conditional GET. A
+    manifest is only fetched if it is missing locally or its entry in the
+    index has changed, and those are fetched in parallel.
+    """
     path = config.BUILD_PATH
     bucket_name = config.BUILD_BUCKET
     file_path = "{path}/index.json".format(path=path)
     folder = "config/{path}/".format(path=path)
+    start_time = time.time()
 
-    logger.info("Downloading index.json for %s in %s to %s...", file_path, bucket_name, folder)
+    logger.info("Syncing index.json for %s in %s to %s...", file_path, bucket_name, folder)
+    try:
+        os.makedirs(folder)
+    except:
+        pass
+    local_filename = os.path.join(folder, "index.json")
+    etags_filename = os.path.join(folder, ETAGS_FILENAME)
     try:
-        conn = connect_to_region(config.S3_REGION_NAME, calling_format=OrdinaryCallingFormat())
+        old_index = _load_json(local_filename)
+        etags = _load_json(etags_filename)
+    except (OSError, IOError, ValueError):
+        old_index = {"refs": []}
+        etags = {}
+    new_etags = dict(etags)
+
+    try:
+        bucket = get_bucket(bucket_name)
     except Exception as e:
         logger.exception("Fatal error! Could not connect to S3 region '%s': %s", config.S3_REGION_NAME, e)
         sys.exit(2)
-    bucket = conn.get_bucket(bucket_name)
-    key = bucket.get_key(file_path)
-    if key is None:
+    ret = _get_if_changed(bucket, file_path, etags.get(file_path))
+    if ret is None:
         logger.error("Index file '%s' not found on S3" % file_path)
         sys.exit(1)
-    contents = key.get_contents_as_string()
-    try:
-        os.makedirs(folder)
-    except:
-        pass
-    local_filename = os.path.join(folder, "index.json")
-    with open(local_filename, "wb") as f:
-        f.write(contents)
+    contents, new_etags[file_path] = ret
+    if contents is None:
+        logger.debug("Index file '%s' has not changed", file_path)
+        d = old_index
+    else:
+        d = json.loads(contents)
 
-    d = json.loads(contents)
+    old_entries = set(json.dumps(entry, sort_keys=True) for entry in old_index["refs"])
+    manifests = {}
     for entry in d["refs"]:
-        path = entry["build_manifest"]
-        key = bucket.get_key(path)
-        if key is None:
-            logger.error("File '%s' not found on S3" % path)
-            sys.exit(1)
-        contents = key.get_contents_as_string()
-        local_filename = os.path.join(folder, path.split("/")[-1])
-        with open(local_filename, "wb") as f:
-            f.write(contents)
+        manifest_path = entry["build_manifest"]
+        manifest_filename = os.path.join(folder, manifest_path.split("/")[-1])
+        if json.dumps(entry, sort_keys=True) in old_entries and os.path.exists(manifest_filename):
+            continue
+        manifests[manifest_path] = manifest_filename
+
+    def fetch_manifest(manifest_path):
+        etag = etags.get(manifest_path) if os.path.exists(manifests[manifest_path]) else None
+        return manifest_path, _get_if_changed(get_bucket(bucket_name), manifest_path, etag)
+
+    num_downloaded = 0
+    if manifests:
+        pool = ThreadPool(min(S3_CONCURRENCY, len(manifests)))
+        try:
+            results = pool.map(fetch_manifest, manifests.keys())
+        finally:
+            pool.close()
+        for manifest_path, ret in results:
+            if ret is None:
+                logger.error("File '%s' not found on S3" % manifest_path)
+                sys.exit(1)
+            manifest_contents, new_etags[manifest_path] = ret
+            if manifest_contents is not None:
+                _write_if_changed(manifests[manifest_path], manifest_contents)
+                num_downloaded += 1
+
+    # The index goes last so it never refers to a manifest we don't have
+    if contents is not None:
+        _write_if_changed(local_filename, contents)
+    if new_etags != etags:
+        _write_if_changed(etags_filename, json.dumps(new_etags, indent=4))
+    logger.info("Synced index in %.2f seconds. Index %s, downloaded %s of %s manifests",
+                time.time() - start_time, "unchanged" if contents is None else "updated",
+                num_downloaded, len(d["refs"]))
 
 def get_manifest(ref):
-    index_file = get_index()
-    try:
-        refitem = [refitem for refitem in index_file["refs"] if refitem["ref"] == ref and refitem["target_platform"] == "WindowsServer"][0]
-    except IndexError:
+    """
+    Return the WindowsServer build manifest for 'ref'. The result is cached
+    and must not be modified.
+    """
+    refitem = get_catalog().find(ref, "WindowsServer")
+    if refitem is None:
         logger.warning("Ref '%s' not found in index file", ref)
         return None
     path = refitem["build_manifest"]
@@ -79,9 +252,7 @@ def get_manifest(ref):
     cnt = 0
     while 1:
         try:
-            with open(local_filename, "r") as f:
-                manifest = json.load(f)
-                break
+            return _load_json(local_filename)
         except Exception as e:
             cnt += 1
             if cnt < 10:
@@ -89,20 +260,46 @@ def get_manifest(ref):
                 time.sleep(1.0)
             else:
                 logger.error("Unable to get manifest from file '%s'. %s", local_filename, e)
-    return manifest
+                return None
 
 def get_index():
+    """
+    Return the contents of the local index.json. The result is cached and
+    must not be modified.
+    """
     folder = "config/{repo}/".format(repo=config.BUILD_PATH)
     local_filename = os.path.join(folder, "index.json")
-    logger.debug("Loading index from '%s'", local_filename)
     if not os.path.exists(local_filename):
         raise RuntimeError("Repository has not been synced")
-    return json.load(open(local_filename))
+    return _load_json(local_filename)
+
+def get_file_listing(build_info):
+    """
+    Return the per-file listing of the build described by the manifest
+    'build_info', or None if the build has none. The listing is published by
+    the build pipeline next to the archive and is referred to by the
+    optional "file_listing" manifest entry. It maps file names in the
+    archive to {"sha1": <hex digest>, "size": <bytes>}.
+    """
+    path = build_info.get("file_listing")
+    if not path:
+        return None
+    result = _get_if_changed(get_bucket(), path)
+    if result is None:
+        logger.warning("File listing '%s' of build '%s' not found on S3", path, build_info["build"])
+        return None
+    return json.loads(result[0])
 
 def is_build_installed(build_name, executable_path):
+    """
+    Return True if the build 'build_name' is installed. A sample of its files
+    is verified and the build is quarantined if any of them are damaged.
+    """
     build_path = os.path.join(config.BSD_BATTLESERVER_FOLDER, build_name)
     executable_path = os.path.join(build_path, executable_path)
     if os.path.exists(executable_path):
+        if not check_build(build_name, VERIFY_SAMPLE_SIZE):
+            return False
         logger.debug("Build '%s' is installed", build_name)
         return True
     else:
@@ -111,11 +308,220 @@ def is_build_installed(build_name, executable_path):
             logger.warning("Folder '%s exists but no .exe found!" % build_path)
         return False
 
+class _DownloadProgress(object):
+    """
+    Thread-safe byte counter that logs download progress every 10%.
+    """
+    def __init__(self, name, total):
+        self.name = name
+        self.total = total
+        self.num_bytes = 0
+        self._reported = 0
+        self._lock = Lock()
+
+    def add(self, num_bytes):
+        with self._lock:
+            self.num_bytes += num_bytes
+            percent = self.num_bytes * 100 // max(self.total, 1)
+            if percent >= self._reported + 10:
+                self._reported = percent - percent % 10
+                logger.info("{}: {:,} bytes of {:,} downloaded ({}%)".format(self.name, self.num_bytes, self.total, self._reported))
+
+class _DownloadState(object):
+    """
+    Records in a sidecar file which byte ranges of a download are safely on
+    disk, so an interrupted download can continue where it left off. The
+    record is only valid for the same object (ETag and size) and range size.
+    """
+    def __init__(self, tmp_path, key):
+        self.filename = tmp_path + ".progress"
+        self.etag = key.etag
+        self.size = key.size
+        self.chunk_size = DOWNLOAD_CHUNK_SIZE
+        self.done = set()
+        self._lock = Lock()
+
+    def load(self):
+        """
+        Pick up the ranges recorded by a previous attempt. Returns False if
+        there is no usable record.
+        """
+        try:
+            with open(self.filename, "r") as f:
+                d = json.load(f)
+        except (IOError, ValueError):
+            return False
+        if (d.get("etag"), d.get("size"), d.get("chunk_size")) != (self.etag, self.size, self.chunk_size):
+            logger.info("Build has changed on S3 since the download of '%s' started", self.filename)
+            return False
+        self.done = set(d["done"])
+        return True
+
+    def range_done(self, start):
+        with self._lock:
+            self.done.add(start)
+            self.save()
+
+    def save(self):
+        d = {
+            "etag": self.etag,
+            "size": self.size,
+            "chunk_size": self.chunk_size,
+            "done": sorted(self.done),
+        }
+        with open(self.filename + ".tmp", "w") as f:
+            json.dump(d, f)
+        replace_file(self.filename + ".tmp", self.filename)
+
+    def remove(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+def _download_range(path, etag, filename, start, end, progress, state):
+    """
+    Fetch bytes 'start' to 'end' (inclusive) of 'path' and write them at the
+    same offset in 'filename'. The request fails if the object on S3 no
+    longer has the ETag 'etag'. The range is recorded in 'state' once it has
+    been flushed to disk.
+    """
+    headers = {"Range": "bytes=%d-%d" % (start, end), "If-Match": etag}
+    for attempt in xrange(DOWNLOAD_RETRIES):
+        num_bytes = 0
+        try:
+            key = get_bucket().new_key(path)
+            key.open_read(headers=headers)
+            with open(filename, "r+b") as f:
+                f.seek(start)
+                while 1:
+                    data = key.read(IO_BUFFER_SIZE)
+                    if not data:
+                        break
+                    f.write(data)
+                    num_bytes += len(data)
+                    progress.add(len(data))
+                f.flush()
+                os.fsync(f.fileno())
+            key.close()
+            if num_bytes != end - start + 1:
+                raise RuntimeError("Got %s bytes for range %s-%s of '%s'" % (num_bytes, start, end, path))
+            state.range_done(start)
+            return
+        except Exception as e:
+            progress.add(-num_bytes)
+            if attempt + 1 == DOWNLOAD_RETRIES:
+                raise
+            logger.warning("Failed to download range %s-%s of '%s'. Retrying: %s", start, end, path, e)
+            # Start over on a fresh connection
+            _connections.conn = None
+
+class S3File(object):
+    """
+    Read-only, seekable file object over an object on S3, e.g. for reading a
+    build archive with ZipFile without downloading it first. Reads are
+    served from range requests of at least 'block_size' bytes so sequential
+    reads stream the object in large blocks. Reads fail if the object
+    changes on S3 while it is open.
+    """
+    def __init__(self, path, key=None, block_size=DOWNLOAD_CHUNK_SIZE):
+        key = key or get_bucket().get_key(path)
+        if not key:
+            raise RuntimeError("File '%s' not found on S3" % path)
+        self.name = path
+        self.size = key.size
+        self.etag = key.etag
+        self.block_size = block_size
+        self.bytes_fetched = 0
+        self._pos = 0
+        self._buf = b""
+        self._buf_start = 0
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += self.size
+        self._pos = max(0, offset)
+
+    def tell(self):
+        return self._pos
+
+    def read(self, n=-1):
+        remaining = self.size - self._pos
+        if n is None or n < 0 or n > remaining:
+            n = remaining
+        if n <= 0:
+            return b""
+        parts = []
+        buf_end = self._buf_start + len(self._buf)
+        if self._buf_start <= self._pos < buf_end:
+            part = self._buf[self._pos - self._buf_start:self._pos - self._buf_start + n]
+            parts.append(part)
+            self._pos += len(part)
+            n -= len(part)
+        if n > 0:
+            start = self._pos
+            end = min(start + max(n, self.block_size), self.size) - 1
+            self._buf = self._fetch(start, end)
+            self._buf_start = start
+            parts.append(self._buf[:n])
+            self._pos += n
+        return b"".join(parts)
+
+    def _fetch(self, start, end):
+        headers = {"Range": "bytes=%d-%d" % (start, end), "If-Match": self.etag}
+        for attempt in xrange(DOWNLOAD_RETRIES):
+            try:
+                data = get_bucket().new_key(self.name).get_contents_as_string(headers=headers)
+                if len(data) != end - start + 1:
+                    raise RuntimeError("Got %s bytes for range %s-%s of '%s'" % (len(data), start, end, self.name))
+                self.bytes_fetched += len(data)
+                return data
+            except Exception as e:
+                if attempt + 1 == DOWNLOAD_RETRIES:
+                    raise
+                logger.warning("Failed to read range %s-%s of '%s'. Retrying: %s", start, end, self.name, e)
+                _connections.conn = None
+
+    def close(self):
+        self._buf = b""
+
+def _file_md5(filename):
+    md5 = hashlib.md5()
+    with open(filename, "rb") as f:
+        for data in iter(lambda: f.read(IO_BUFFER_SIZE), b""):
+            md5.update(data)
+    return md5.hexdigest()
+
+def _verify_download(key, filename):
+    """
+    Check the downloaded file against the size of 'key' and its MD5. The MD5
+    is the ETag for objects uploaded in one part. For multipart uploads it is
+    only known if the uploader stored it in the 'md5' metadata field.
+    """
+    size = os.path.getsize(filename)
+    if size != key.size:
+        raise RuntimeError("Downloaded file '%s' is %s bytes but should be %s" % (filename, size, key.size))
+    expected_md5 = key.get_metadata("md5")
+    etag = key.etag.strip('"')
+    if not expected_md5 and "-" not in etag:
+        expected_md5 = etag
+    if not expected_md5:
+        logger.info("No checksum available for '%s'. Only the size was verified", key.name)
+        return
+    md5 = _file_md5(filename)
+    if md5 != expected_md5:
+        raise RuntimeError("Downloaded file '%s' has MD5 %s but should have %s" % (filename, md5, expected_md5))
+
 def download_build(filename, ignore_if_exists=False):
+    """
+    Download the build archive 'filename' from S3 to BSD_TEMP_FOLDER and
+    return the local path. The file is fetched as byte ranges in parallel
+    into a preallocated '.tmp' file which is verified and then renamed.
+    If an earlier download of the same object was interrupted, the ranges
+    it completed are not fetched again.
+    """
     logger.info("Downloading build %s...", filename)
-    bucket_name = config.BUILD_BUCKET
-    conn = connect_to_region(config.S3_REGION_NAME, calling_format=OrdinaryCallingFormat())
-    bucket = conn.get_bucket(bucket_name)
+    bucket = get_bucket()
     path = filename#"ue4-builds/{repo}/{filename}".format(repo=repository, filename=filename)
     head, tail = os.path.split(path)
     dest_path = os.path.abspath(os.path.join(config.BSD_TEMP_FOLDER, tail))
@@ -133,44 +539,117 @@ def download_build(filename, ignore_if_exists=False):
     if not os.path.exists(config.BSD_TEMP_FOLDER):
         os.makedirs(config.BSD_TEMP_FOLDER)
 
-    def cb(num_bytes, total):
-        logger.debug("{:,} bytes of {:,} downloaded".format(num_bytes, total))
+    tmp_path = dest_path + ".tmp"
+    state = _DownloadState(tmp_path, key)
+    if os.path.exists(tmp_path) and state.load():
+        logger.info("Resuming download of '%s'. %s ranges were already downloaded", path, len(state.done))
+    else:
+        with open(tmp_path, "wb") as fp:
+            fp.truncate(key.size)
+        state.save()
+
+    start_time = time.time()
+    ranges = [(start, min(start + DOWNLOAD_CHUNK_SIZE, key.size) - 1)
+              for start in xrange(0, key.size, DOWNLOAD_CHUNK_SIZE)]
+    resumed_bytes = sum(end - start + 1 for start, end in ranges if start in state.done)
+    ranges = [r for r in ranges if r[0] not in state.done]
+    progress = _DownloadProgress(tail, key.size)
+    progress.add(resumed_bytes)
+    if ranges:
+        pool = ThreadPool(min(DOWNLOAD_CONCURRENCY, len(ranges)))
+        try:
+            pool.map(lambda r: _download_range(path, key.etag, tmp_path, r[0], r[1], progress, state), ranges, chunksize=1)
+        finally:
+            # Let the ranges in flight finish so they are recorded for a resume
+            pool.close()
+            pool.join()
+    download_time = time.time() - start_time
 
-    with open(dest_path + ".tmp", "wb") as fp:
-        key.get_file(fp=fp, cb=cb, num_cb=100)
+    try:
+        _verify_download(key, tmp_path)
+    except Exception:
+        # Don't resume from a file that is known to be bad
+        os.remove(tmp_path)
+        state.remove()
+        raise
+    replace_file(tmp_path, dest_path)
+    state.remove()
 
-    os.rename(dest_path + ".tmp", dest_path)
+    total_time = time.time() - start_time
+    details = {
+        "archive": path,
+        "bytes": key.size,
+        "resumed_bytes": resumed_bytes,
+        "ranges": len(ranges),
+        "concurrency": DOWNLOAD_CONCURRENCY,
+        "download_seconds": round(download_time, 2),
+        "verify_seconds": round(total_time - download_time, 2),
+        "mb_per_second": round((key.size - resumed_bytes) / 1024.0 / 1024.0 / max(download_time, 0.001), 2),
+    }
+    logger.info("Downloaded {:,} bytes of '{}' in {:.1f} seconds ({} MB/s)".format(key.size - resumed_bytes, path, download_time, details["mb_per_second"]))
+    log_event("download_build_metrics", "Downloaded build '%s'" % tail, details=details)
 
     return dest_path
 
-def cleanup_s3(repository):
+def cleanup_s3(dry_run=False, max_days=CLEANUP_MAX_DAYS):
     """
-    Slapped together to clean up old unused builds on S3
+    Delete the build files on S3 that are older than 'max_days' and belong
+    to builds no ref in the index points at. The listing is fetched a page
+    at a time and each page is deleted with batched DeleteObjects requests.
+    With 'dry_run' nothing is deleted. Returns a summary of what was (or
+    would have been) deleted.
     """
-    MAX_DAYS = 30
-
-    bucket_name = config.BUILD_BUCKET
+    bucket = get_bucket(config.BUILD_BUCKET)
     path = "ue4-builds/{path}/WindowsServer/".format(path=config.BUILD_PATH) #! WindowsServer hardcoded
-    index = get_index()
-    conn = connect_to_region(config.S3_REGION_NAME, calling_format=OrdinaryCallingFormat())
-    bucket = conn.get_bucket(bucket_name)
-    now = datetime.datetime.utcnow()
-    files = []
-    for f in bucket.list(prefix=path, delimiter="/"): 
-        dt = parser.parse(f.last_modified).replace(tzinfo=None)
-        diff = now - dt
-
-        filename = f.name.split("/")[-1]
-        build_number = filename.split(".")[-2]
-
-        if diff.days > MAX_DAYS:
-            for entry in index["refs"]:
-                if "."+build_number+"." in entry["build_manifest"]:
-                    break
-            else:
-                files.append((filename, diff.days, f.name, build_number, dt))
-                print "Deleting build %s from %s..." % (filename, dt)
-                f.delete()
+    catalog = get_catalog()
+    # S3 timestamps are ISO 8601 in UTC so they can be compared as strings
+    cutoff = (datetime.datetime.utcnow() - datetime.timedelta(days=max_days)).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+    start_time = time.time()
+    num_listed = 0
+    num_deleted = 0
+    bytes_deleted = 0
+    num_errors = 0
+    marker = ""
+    while 1:
+        page = bucket.get_all_keys(prefix=path, delimiter="/", marker=marker, max_keys=CLEANUP_BATCH_SIZE)
+        keys = [key for key in page if isinstance(key, Key)]
+        num_listed += len(keys)
+        to_delete = []
+        for key in keys:
+            if key.last_modified >= cutoff:
+                continue
+            parsed = parse_build_filename(key.name.split("/")[-1])
+            if parsed and not catalog.has_build(parsed[1]):
+                to_delete.append(key)
+
+        for key in to_delete:
+            logger.debug("%s build file %s from %s", "Would delete" if dry_run else "Deleting", key.name, key.last_modified)
+        if to_delete and not dry_run:
+            result = bucket.delete_keys([key.name for key in to_delete], quiet=True)
+            for error in result.errors:
+                logger.warning("Could not delete '%s' from S3: %s", error.key, error.message)
+            failed = set(error.key for error in result.errors)
+            num_errors += len(failed)
+            to_delete = [key for key in to_delete if key.name not in failed]
+        num_deleted += len(to_delete)
+        bytes_deleted += sum(key.size for key in to_delete)
+
+        if not page.is_truncated:
+            break
+        marker = page.next_marker or page[-1].name
 
-    files.sort(key=lambda x: x[1], reverse=True)
-    print "Deleted %s files from S3" % len(files)
+    details = {
+        "dry_run": dry_run,
+        "max_days": max_days,
+        "listed": num_listed,
+        "deleted": num_deleted,
+        "bytes": bytes_deleted,
+        "errors": num_errors,
+        "seconds": round(time.time() - start_time, 2),
+    }
+    print "%s %s of %s files (%.1f MB) from S3 in %.1f seconds" % (
+        "Would delete" if dry_run else "Deleted", num_deleted, num_listed,
+        bytes_deleted / 1024.0 / 1024.0, details["seconds"])
+    if not dry_run:
+        log_event("cleanup_s3", "Deleted %s old build files from S3" % num_deleted, details=details)
+    return details
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+    Drift game server management - Supervisor
+    ------------------------------------------------
+    Hosts a Daemon for every (ref, tenant) configured on this machine in one
+    long-lived process. The daemons share a single reactor as well as the
+    index cache, REST sessions and port allocation of the process. Looking up
+    the refs and loading daemons happens in the background so a slow backend
+    or disk doesn't hold up the daemons already running.
+"""
+from multiprocessing.pool import ThreadPool
+
+from logsetup import logger, log_event
+from reactor import Reactor
+
+from serverdaemon.daemon import Daemon
+from serverdaemon.s3 import get_manifest
+from serverdaemon.utils import get_local_refs
+
+# Seconds between checks of which refs this machine should be running
+REFS_CHECK_INTERVAL = 60.0
+# Seconds before a daemon that has exited is started up again
+RESTART_DELAY = 10.0
+# Number of threads looking up refs and loading daemons
+BACKGROUND_CONCURRENCY = 2
+
+
+class Supervisor(object):
+    def __init__(self):
+        self.reactor = Reactor()
+        self.daemons = {}
+        self.wanted_refs = set()
+        # Refs whose daemon is being loaded in the background
+        self._loading = set()
+        self._background_pool = ThreadPool(BACKGROUND_CONCURRENCY)
+
+    def check_refs(self):
+        self.reactor.call_later(REFS_CHECK_INTERVAL, self.check_refs)
+        self.reactor.run_in_pool(self._background_pool, get_local_refs, (), self.on_refs_loaded)
+
+    def on_refs_loaded(self, wanted_refs):
+        """
+        Start daemons for refs that were added to this machine and shut down
+        the ones that were removed.
+        """
+        if wanted_refs is None:
+            # Logged by run_in_pool. Tried again on the next check.
+            return
+        self.wanted_refs = wanted_refs
+
+        for ref in set(self.daemons) - self.wanted_refs:
+            logger.warning("Ref '%s' is no longer configured on this machine", str(ref))
+            self.daemons[ref].shutdown_servers_and_exit("Ref removed from machine")
+            log_event("remove_ref", "Stopped daemon for ref '%s'" % ref[0], ref=ref[0], tenant_name=ref[1])
+        self.start_daemons()
+
+    def start_daemons(self):
+        for ref in self.wanted_refs - set(self.daemons) - self._loading:
+            self._loading.add(ref)
+            self.reactor.run_in_pool(self._background_pool, load_daemon, (ref,), self.on_daemon_loaded, (ref,))
+
+    def on_daemon_loaded(self, ref, d):
+        self._loading.discard(ref)
+        if d is None:
+            return
+        if ref not in self.wanted_refs:
+            logger.info("Ref '%s' was removed from this machine while its daemon was loading", str(ref))
+            return
+        d.start(self.reactor, on_exit=self.on_daemon_exit)
+        self.daemons[ref] = d
+        log_event("add_ref", "Started daemon for ref '%s'" % d.ref, ref=d.ref, tenant_name=d.tenant)
+
+    def on_daemon_exit(self, daemon):
+        self.daemons.pop((daemon.ref, daemon.tenant), None)
+        # Bring the ref back up, picking up a new build if that was the reason
+        self.reactor.call_later(RESTART_DELAY, self.start_daemons)
+
+    def run(self):
+        logger.info("Supervisor starting")
+        self.reactor.call_soon(self.check_refs)
+        try:
+            self.reactor.run()
+        except KeyboardInterrupt:
+            logger.info("User exiting...")
+            for d in self.daemons.values():
+                d.shutdown_servers_and_exit("User exit", wait=True)
+
+
+def load_daemon(ref):
+    """
+    Create the daemon for the (ref, tenant) pair 'ref' and pick its build.
+    Returns None if no build is installed for it. Runs on a background
+    thread.
+    """
+    ref_name, tenant = ref
+    if not get_manifest(ref_name):
+        logger.warning("Build not found for ref '%s'. Not starting daemon.", ref_name)
+        return None
+    d = Daemon(ref_name, tenant)
+    if not d.load_build():
+        return None
+    return d
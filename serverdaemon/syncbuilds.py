@@ -1,13 +1,41 @@
 # -*- coding: utf-8 -*-
-import sys, shutil, os
+import sys, shutil, os, time, errno, heapq, collections, threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 from serverdaemon.utils import get_ts, get_tags
-from serverdaemon.utils import update_state, get_local_refs
+from serverdaemon.utils import update_state, get_local_refs, free_disk_space
 from serverdaemon import config
-from serverdaemon.s3 import get_manifest, is_build_installed, download_build
+from serverdaemon.config import config_file
+from serverdaemon.s3 import get_manifest, is_build_installed, download_build, get_bucket, S3File
+from serverdaemon.s3 import get_file_listing, DOWNLOAD_CHUNK_SIZE
+from serverdaemon import buildstore
+from serverdaemon.buildcache import ensure_free_space, touch_build, pinned
+from serverdaemon.buildverify import check_build
 from logsetup import logger, log_event
 import boto3
 from zipfile import ZipFile
 
+# Install builds straight from S3 instead of downloading the archive first
+STREAM_INSTALL = config_file.get("stream-install", False)
+# Number of threads extracting a build archive
+EXTRACT_CONCURRENCY = config_file.get("extract-concurrency", 4)
+# Share identical files between builds through the content addressed store
+BUILD_STORE = config_file.get("build-store", False)
+# Range size for fetching the changed files of a delta update. Smaller than
+# a download chunk as changed files are usually scattered over the archive.
+DELTA_BLOCK_SIZE = 2 * 1024 * 1024
+# Number of builds synced at once. Each download uses "download-concurrency"
+# connections of its own.
+SYNC_CONCURRENCY = config_file.get("sync-concurrency", 2)
+# Disk space to keep free on the build drive while syncing
+MIN_FREE_DISK_MB = config_file.get("min-free-disk-mb", 4096)
+# Disk space a build takes while syncing, relative to its archive size: the
+# archive itself plus the extracted files
+DISK_USAGE_FACTOR = 3
+# Number of times a build is installed before giving up on it failing
+# verification
+INSTALL_ATTEMPTS = 2
+
 """
 
     {
@@ -20,6 +48,127 @@ from zipfile import ZipFile
 
 """
 
+def _publish_build(image_name, extract, ignore_if_exists=False):
+    """
+    Extract a build with 'extract(staging_folder)' and publish it atomically
+    as 'image_name' in BSD_BATTLESERVER_FOLDER. See install_build().
+    'extract' returns the listing of the files it put in the build store, if
+    any, which is registered once the build is published.
+    """
+    # The final destination of the build
+    dest_folder = os.path.join(config.BSD_BATTLESERVER_FOLDER, image_name)
+    dest_folder = os.path.abspath(dest_folder)
+    if ignore_if_exists and os.path.exists(dest_folder):
+        return image_name
+
+    update_state(
+        state='PROGRESS',
+        meta={'file': image_name, 'step': 'unzipping'},
+    )
+
+    # Extract to a staging folder
+    staging_folder = dest_folder + ".temp"
+
+    try:
+        listing = extract(staging_folder)
+        # Publish the build
+        update_state(
+            state='PROGRESS',
+            meta={'file': image_name, 'step': 'publishing'},
+        )
+        if os.path.exists(dest_folder):
+            logger.info("Removing previous install at %s", dest_folder)
+            shutil.rmtree(dest_folder, ignore_errors=False)
+        logger.info("Publishing %s to %s", staging_folder, dest_folder)
+        os.rename(staging_folder, dest_folder)
+        touch_build(image_name)
+        if listing:
+            _register_build(image_name, listing)
+    finally:
+        # Remove staging folder, if needed.
+        if os.path.exists(staging_folder):
+            logger.debug("Removing staging folder %s", staging_folder)
+            shutil.rmtree(staging_folder)
+
+    return image_name
+
+def _register_build(image_name, listing):
+    buildstore.register_build(image_name, listing)
+    new_entries = [entry for entry in listing.itervalues() if entry["new"]]
+    details = {
+        "files": len(listing),
+        "bytes": sum(entry["size"] for entry in listing.itervalues()),
+        "new_files": len(new_entries),
+        "new_bytes": sum(entry["size"] for entry in new_entries),
+    }
+    logger.info("Build '%s' added %s of %s files (%.0f of %.0f MB) to the build store", image_name,
+                details["new_files"], details["files"],
+                details["new_bytes"] / 1024.0 / 1024.0, details["bytes"] / 1024.0 / 1024.0)
+    log_event("build_store_metrics", "Installed build '%s' through the build store" % image_name, details=details)
+
+def _extract_member(zipfile, member, folder):
+    """
+    Extract 'member' into 'folder'. Returns its build store listing entry
+    when the build store is used.
+    """
+    if BUILD_STORE:
+        return buildstore.extract_member(zipfile, member, folder)
+    try:
+        zipfile.extract(member, folder)
+    except OSError as e:
+        # Another thread created the same parent folder at the same time
+        if e.errno != errno.EEXIST:
+            raise
+        zipfile.extract(member, folder)
+
+def _extract_group(zipfile, group, folder):
+    listing = {}
+    for member in group:
+        entry = _extract_member(zipfile, member, folder)
+        if entry:
+            listing[member.filename] = entry
+    return listing
+
+def _balance_by_size(members, num_groups):
+    """
+    Spread archive members over at most 'num_groups' groups with about the
+    same compressed size each. The largest members are placed first, each
+    into the group that is smallest so far.
+    """
+    heap = [(0, i, []) for i in xrange(num_groups)]
+    for member in sorted(members, key=lambda m: m.compress_size, reverse=True):
+        size, i, group = heapq.heappop(heap)
+        group.append(member)
+        heapq.heappush(heap, (size + member.compress_size, i, group))
+    return [group for size, i, group in heap if group]
+
+def extract_parallel(zipfile_path, folder, num_threads=None):
+    """
+    Extract the zip file 'zipfile_path' into 'folder' like ZipFile.extractall
+    but using 'num_threads' threads, each with its own handle on the archive.
+    zlib and file writes release the GIL so the threads run concurrently.
+    By default one thread per core is used, up to "extract-concurrency".
+    Returns the build store listing of the extracted files.
+    """
+    num_threads = num_threads or min(EXTRACT_CONCURRENCY, multiprocessing.cpu_count())
+    with ZipFile(zipfile_path) as zipfile:
+        members = zipfile.infolist()
+    groups = _balance_by_size(members, num_threads)
+
+    def extract_group(group):
+        with ZipFile(zipfile_path) as zipfile:
+            return _extract_group(zipfile, group, folder)
+
+    pool = ThreadPool(len(groups) or 1)
+    try:
+        listing = {}
+        for group_listing in pool.map(extract_group, groups, chunksize=1):
+            listing.update(group_listing)
+        return listing
+    finally:
+        pool.close()
+        pool.join()
+
 def install_build(zipfile_name, ignore_if_exists=False):
     """
     Install server build on local drive. 'zipfile_name' is the name of the
@@ -38,47 +187,273 @@ def install_build(zipfile_name, ignore_if_exists=False):
     head, tail = os.path.split(zipfile_name)
     image_name, ext = os.path.splitext(tail)
 
-    # The final destination of the build
-    dest_folder = os.path.join(config.BSD_BATTLESERVER_FOLDER, image_name)
-    dest_folder = os.path.abspath(dest_folder)
-    if ignore_if_exists and os.path.exists(dest_folder):
-        return image_name
-
     zipfile_path = os.path.join(config.BSD_TEMP_FOLDER, zipfile_name)
     zipfile_path = os.path.abspath(zipfile_path)
     if not os.path.exists(zipfile_path):
         raise RuntimeError("Zipfile '{}' not found!".format(zipfile_path))
 
+    def extract(staging_folder):
+        logger.info("Unzipping %s to %s", zipfile_path, staging_folder)
+        start_time = time.time()
+        listing = extract_parallel(zipfile_path, staging_folder)
+        logger.info("Unzipped %s in %.1f seconds", zipfile_path, time.time() - start_time)
+        return listing
 
-    with ZipFile(zipfile_path) as zipfile:
-        update_state(
-            state='PROGRESS',
-            meta={'file': tail, 'step': 'unzipping'},
-        )
+    return _publish_build(image_name, extract, ignore_if_exists)
+
+def _split_by_offset(members, num_groups):
+    """
+    Split archive members into at most 'num_groups' runs of consecutive
+    members with roughly the same compressed size each. Each run covers one
+    contiguous region of the archive so it can be streamed in one pass.
+    """
+    members = sorted(members, key=lambda m: m.header_offset)
+    target_size = sum(m.compress_size for m in members) // num_groups + 1
+    groups = []
+    group = []
+    group_size = 0
+    for member in members:
+        group.append(member)
+        group_size += member.compress_size
+        if group_size >= target_size:
+            groups.append(group)
+            group = []
+            group_size = 0
+    if group:
+        groups.append(group)
+    return groups
+
+def _stream_extract(archive, key, members, folder, block_size=DOWNLOAD_CHUNK_SIZE):
+    """
+    Extract 'members' of the archive 'archive' on S3 into 'folder' using
+    several threads, each streaming its own contiguous region of the
+    archive. Returns a tuple of (bytes_fetched, listing, num_threads).
+    """
+    groups = _split_by_offset(members, EXTRACT_CONCURRENCY)
+
+    def extract_group(group):
+        remote_file = S3File(archive, key, block_size)
+        with ZipFile(remote_file) as zipfile:
+            group_listing = _extract_group(zipfile, group, folder)
+        return remote_file.bytes_fetched, group_listing
+
+    pool = ThreadPool(len(groups) or 1)
+    try:
+        bytes_fetched = 0
+        listing = {}
+        for group_bytes, group_listing in pool.map(extract_group, groups, chunksize=1):
+            bytes_fetched += group_bytes
+            listing.update(group_listing)
+    finally:
+        pool.close()
+        pool.join()
+    return bytes_fetched, listing, len(groups)
+
+def stream_install_build(archive, ignore_if_exists=False):
+    """
+    Install the build 'archive' straight from S3 without a local copy of the
+    zip file. The central directory of the archive is read first, then the
+    members are streamed and extracted by several threads, each reading its
+    own contiguous region of the archive. Publishing works as in
+    install_build().
+    """
+    head, tail = os.path.split(archive)
+    image_name, ext = os.path.splitext(tail)
+
+    def extract(staging_folder):
+        start_time = time.time()
+        key = get_bucket().get_key(archive)
+        if not key:
+            raise RuntimeError("Build '%s' not found on S3" % archive)
+        with ZipFile(S3File(archive, key)) as zipfile:
+            members = zipfile.infolist()
+        logger.info("Streaming %s files from %s to %s", len(members), archive, staging_folder)
+        bytes_fetched, listing, num_threads = _stream_extract(archive, key, members, staging_folder)
+
+        seconds = time.time() - start_time
+        details = {
+            "archive": archive,
+            "bytes": key.size,
+            "bytes_fetched": bytes_fetched,
+            "files": len(members),
+            "threads": num_threads,
+            "seconds": round(seconds, 2),
+            "mb_per_second": round(bytes_fetched / 1024.0 / 1024.0 / max(seconds, 0.001), 2),
+        }
+        logger.info("Streamed and extracted '%s' in %.1f seconds (%s MB/s)", archive, seconds, details["mb_per_second"])
+        log_event("stream_install_metrics", "Streamed build '%s'" % tail, details=details)
+        return listing
+
+    return _publish_build(image_name, extract, ignore_if_exists)
+
+def delta_install_build(build_info, file_listing, ignore_if_exists=False):
+    """
+    Install the build described by the manifest 'build_info' using its
+    per-file listing 'file_listing' (see get_file_listing()). Files whose
+    contents are already in the build store, typically because the
+    previous build of the ref has them, are linked from there. Only the
+    remaining members are read from the archive on S3, as byte ranges.
+    Publishing works as in install_build().
+    """
+    archive = build_info["archive"]
+    head, tail = os.path.split(archive)
+    image_name, ext = os.path.splitext(tail)
+
+    def extract(staging_folder):
+        start_time = time.time()
+        key = get_bucket().get_key(archive)
+        if not key:
+            raise RuntimeError("Build '%s' not found on S3" % archive)
+        # Only the central directory is read here
+        with ZipFile(S3File(archive, key, DELTA_BLOCK_SIZE)) as zipfile:
+            members = zipfile.infolist()
+
+        listing = {}
+        changed_members = []
+        for member in members:
+            entry = file_listing.get(member.filename)
+            entry = entry and buildstore.link_member(member, staging_folder, entry["sha1"])
+            if entry:
+                listing[member.filename] = entry
+            else:
+                changed_members.append(member)
+        logger.info("Build '%s': %s files unchanged, fetching %s from %s", image_name,
+                    len(listing), len(changed_members), archive)
+
+        bytes_fetched, changed_listing, num_threads = _stream_extract(
+            archive, key, changed_members, staging_folder, DELTA_BLOCK_SIZE)
+        for filename, entry in changed_listing.iteritems():
+            expected = file_listing.get(filename)
+            if expected and expected["sha1"] != entry["sha1"]:
+                raise RuntimeError("File '%s' in '%s' does not match the file listing" % (filename, archive))
+        listing.update(changed_listing)
+
+        seconds = time.time() - start_time
+        details = {
+            "archive": archive,
+            "bytes": key.size,
+            "bytes_fetched": bytes_fetched,
+            "files": len(members),
+            "files_linked": len(members) - len(changed_members),
+            "files_fetched": len(changed_members),
+            "threads": num_threads,
+            "seconds": round(seconds, 2),
+        }
+        logger.info("Installed '%s' in %.1f seconds, fetching %.1f of %.1f MB", archive, seconds,
+                    bytes_fetched / 1024.0 / 1024.0, key.size / 1024.0 / 1024.0)
+        log_event("delta_install_metrics", "Delta installed build '%s'" % tail, details=details)
+        return listing
+
+    return _publish_build(image_name, extract, ignore_if_exists)
+
+class _DiskBudget(object):
+    """
+    Admits builds for syncing while the drive keeps 'min_free' bytes free
+    after the space reserved by the builds already being synced. A build is
+    always admitted when nothing else is being synced so a build larger
+    than the budget still gets its chance.
+    """
+    def __init__(self, folder, min_free):
+        self.folder = folder
+        self.min_free = min_free
+        self.reserved = 0
+        self.condition = threading.Condition()
+
+    def reserve(self, size):
+        with self.condition:
+            while self.reserved and free_disk_space(self.folder) - self.reserved - size < self.min_free:
+                self.condition.wait(1.0)
+            self.reserved += size
+
+    def release(self, size):
+        with self.condition:
+            self.reserved -= size
+            self.condition.notify_all()
+
+def plan_sync(refs, force=False):
+    """
+    Group the (ref, tenant) pairs in 'refs' by the build they run. Returns a
+    list of (build_info, [(ref, tenant), ...]) with one entry for each build
+    that needs to be installed. Each ref's manifest is looked up once.
+    """
+    build_info_by_ref = {}
+    builds = collections.OrderedDict()
+    for ref, tenant in sorted(refs):
+        if ref not in build_info_by_ref:
+            build_info_by_ref[ref] = get_manifest(ref)
+        build_info = build_info_by_ref[ref]
+        if build_info is None:
+            logger.info("Build %s not found. Ignoring ref.", ref)
+            continue
+        builds.setdefault(build_info["build"], (build_info, []))[1].append((ref, tenant))
+
+    plan = []
+    for build_name, (build_info, targets) in builds.iteritems():
+        if not force and is_build_installed(build_name, build_info["executable_path"]):
+            logger.info("Build '%s' already installed" % build_name)
+            continue
+        plan.append((build_info, targets))
+    return plan
 
-        # Extract to a staging folder
-        staging_folder = dest_folder + ".temp"
+def _install(build_info, targets, log_details, force):
+    file_listing = get_file_listing(build_info) if BUILD_STORE else None
+    if file_listing:
+        delta_install_build(build_info, file_listing)
+    elif STREAM_INSTALL:
+        stream_install_build(build_info["archive"])
+    else:
+        local_filename = download_build(build_info["archive"], ignore_if_exists=(not force))
+        log_details["local_filename"] = local_filename
+        for ref, tenant in targets:
+            log_event("download_build_complete", "Finished downloading build for ref '%s'" % ref, details=log_details, tenant_name=tenant)
+        logger.info("Done downloading '%s' to %s" % (build_info["archive"], local_filename))
+
+        install_build(local_filename)
 
+def sync_build(build_info, targets, disk_budget, force=False):
+    """
+    Download and install one build for the (ref, tenant) pairs 'targets'.
+    """
+    build_name = build_info["build"]
+    print "Checking out build '%s'" % build_name
+    log_details = {"archive": build_info["archive"]}
+    for ref, tenant in targets:
+        log_event("download_build", "Downloading build for ref '%s'" % ref, details=log_details, tenant_name=tenant)
+
+    key = get_bucket().get_key(build_info["archive"])
+    if not key:
+        raise RuntimeError("Build '%s' not found on S3" % build_info["archive"])
+    disk_size = key.size * DISK_USAGE_FACTOR
+    queued_time = time.time()
+    with pinned(build_name):
+        ensure_free_space(disk_size)
+        disk_budget.reserve(disk_size)
         try:
-            logger.info("Unzipping %s to %s", zipfile_path, staging_folder)
-            zipfile.extractall(staging_folder)
-            # Publish the build
-            update_state(
-                state='PROGRESS',
-                meta={'file': tail, 'step': 'publishing'},
-            )
-            if os.path.exists(dest_folder):
-                logger.info("Removing previous install at %s", dest_folder)
-                shutil.rmtree(dest_folder, ignore_errors=False)
-            logger.info("Publishing %s to %s", staging_folder, dest_folder)
-            os.rename(staging_folder, dest_folder)
+            start_time = time.time()
+            for attempt in xrange(INSTALL_ATTEMPTS):
+                _install(build_info, targets, log_details, force)
+                if check_build(build_name):
+                    break
+                # The zip file may be what is damaged
+                force = True
+            else:
+                raise RuntimeError("Build '%s' failed verification after %s attempts" % (build_name, INSTALL_ATTEMPTS))
         finally:
-            # Remove staging folder, if needed.
-            if os.path.exists(staging_folder):
-                logger.debug("Removing staging folder %s", staging_folder)
-                shutil.rmtree(staging_folder)
+            disk_budget.release(disk_size)
 
-    return image_name
+    for ref, tenant in targets:
+        log_event("install_build_complete", "Finished installing build for ref '%s'" % ref, details=log_details, tenant_name=tenant)
+    details = {
+        "build": build_name,
+        "archive": build_info["archive"],
+        "bytes": key.size,
+        "refs": sorted(set(ref for ref, tenant in targets)),
+        "tenants": sorted(set(tenant for ref, tenant in targets)),
+        "queued_seconds": round(start_time - queued_time, 2),
+        "seconds": round(time.time() - start_time, 2),
+    }
+    logger.info("Synced build '%s' in %.1f seconds", build_name, details["seconds"])
+    log_event("sync_build_metrics", "Synced build '%s'" % build_name, details=details)
 
 def download_latest_builds(force=False):
     ts = get_ts()
@@ -98,25 +473,26 @@ def download_latest_builds(force=False):
     if refs:
         logger.info('Syncing builds for the following refs: %s' % repr(refs))
 
-    for ref, tenant in refs:
-        build_info = get_manifest(ref)
-        if build_info is None:
-            logger.info("Build %s not found. Ignoring ref.", ref)
-            continue
-        build_name = build_info["build"]
-        print "Checking out build '%s'" % build_name
-        if not force and is_build_installed(build_name, build_info["executable_path"]):
-            logger.info("Build '%s' already installed" % build_name)
-            continue
-        log_details = {"archive": build_info["archive"]}
-        log_event("download_build", "Downloading build for ref '%s'" % ref, details=log_details, tenant_name=tenant)
-
-        local_filename = download_build(build_info["archive"], ignore_if_exists=(not force))
-        log_details["local_filename"] = local_filename
-        log_event("download_build_complete", "Finished downloading build for ref '%s'" % ref, details=log_details, tenant_name=tenant)
-        logger.info("Done downloading '%s' to %s" % (build_info["archive"], local_filename))
-
-        install_build(local_filename)
+    plan = plan_sync(refs, force)
+    if not plan:
+        return
+    start_time = time.time()
+    disk_budget = _DiskBudget(config.BSD_BATTLESERVER_FOLDER, MIN_FREE_DISK_MB * 1024 * 1024)
 
+    def sync(item):
+        build_info, targets = item
+        try:
+            sync_build(build_info, targets, disk_budget, force)
+        except Exception:
+            logger.exception("Failed to sync build '%s'", build_info["build"])
+            return build_info["build"]
 
-        log_event("install_build_complete", "Finished installing build for ref '%s'" % ref, details=log_details, tenant_name=tenant)
\ No newline at end of file
+    pool = ThreadPool(min(SYNC_CONCURRENCY, len(plan)))
+    try:
+        failed = [build_name for build_name in pool.map(sync, plan, chunksize=1) if build_name]
+    finally:
+        pool.close()
+        pool.join()
+    logger.info("Synced %s builds in %.1f seconds", len(plan) - len(failed), time.time() - start_time)
+    if failed:
+        raise RuntimeError("Failed to sync builds %s" % ", ".join(failed))
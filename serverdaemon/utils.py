@@ -8,12 +8,20 @@ import logging
 import requests
 import platform
 from socket import gethostname
+from contextlib import contextmanager
 import boto.ec2
+import psutil
 import config
 from logsetup import logger
 
 from driftconfig.util import get_domains
 
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+    import fcntl
+
 ec2_metadata = "http://169.254.169.254/latest/meta-data/"
 
 def get_local_refs():
@@ -38,6 +46,83 @@ def get_local_refs():
         refs.add((r['ref'], r['tenant_name']))
     return refs
 
+def replace_file(src, dst):
+    """
+    Rename 'src' to 'dst', replacing 'dst' if it exists, as a single step so
+    readers see either the old or the new file. os.rename can't do this on
+    Windows.
+    """
+    if sys.platform == "win32":
+        import ctypes
+        MOVEFILE_REPLACE_EXISTING = 0x1
+        if not ctypes.windll.kernel32.MoveFileExW(unicode(src), unicode(dst), MOVEFILE_REPLACE_EXISTING):
+            raise ctypes.WinError()
+    else:
+        os.rename(src, dst)
+
+@contextmanager
+def file_lock(filename):
+    """
+    Hold an exclusive lock on 'filename', shared by all processes on the
+    machine, for the duration of the block.
+    """
+    folder = os.path.dirname(filename)
+    if not os.path.exists(folder):
+        try:
+            os.makedirs(folder)
+        except OSError:
+            pass
+    with open(filename, "a+b") as f:
+        if msvcrt:
+            f.seek(0)
+            while 1:
+                try:
+                    # LK_LOCK retries for 10 seconds before giving up
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except IOError:
+                    logger.warning("Still waiting for lock on '%s'", filename)
+        else:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if msvcrt:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+def free_disk_space(folder):
+    """
+    Return the number of bytes free on the drive of 'folder'. The folder is
+    created if it doesn't exist, as it is after all builds were deleted.
+    """
+    if not os.path.exists(folder):
+        try:
+            os.makedirs(folder)
+        except OSError:
+            # Created by another process in the meantime
+            pass
+    return psutil.disk_usage(folder).free
+
+def set_low_priority():
+    """
+    Lower the CPU and I/O priority of this process so it doesn't compete
+    with the battleservers.
+    """
+    p = psutil.Process(os.getpid())
+    try:
+        if sys.platform == "win32":
+            p.nice(psutil.BELOW_NORMAL_PRIORITY_CLASS)
+            if hasattr(psutil, "IOPRIO_LOW"):
+                p.ionice(psutil.IOPRIO_LOW)
+        else:
+            p.nice(10)
+            p.ionice(psutil.IOPRIO_CLASS_IDLE)
+    except (psutil.Error, OSError, ValueError) as e:
+        logger.warning("Could not lower the priority of this process: %s", e)
+
 def update_state(state, meta):
     #! This appears to be some placeholder
     print "update_state: %s - %s" % (state, meta)